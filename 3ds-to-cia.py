@@ -24,25 +24,182 @@ import sys
 import glob
 import struct
 from ctypes import *
+import ctypes.util
 
 import zipfile
+import tarfile
+import zlib
 import tempfile
 import shutil
 import binascii
 import re
 
 import hashlib
+import hmac
 import subprocess
 import platform
 import stat
+import mmap
+import errno
+import argparse
+import multiprocessing
+import signal
+import StringIO
+import io
+import sqlite3
+import json
+import time
+import contextlib
+import collections
+import csv
+import cProfile
+import pstats
+import select
+import fnmatch
+import threading
+import Queue
+import BaseHTTPServer
 
 # pip install colorama
 import colorama
 
-VERBOSE = len(sys.argv) > 1 and sys.argv[1] == '-v'
+# optional, speeds up xorpad application (pip install numpy)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VERBOSE = False
+# profile the conversions run by the workers, see convert_job()
+PROFILE = False
 
 BITS = "64" if platform.machine().endswith("64") else "32"
 
+CHUNK_SIZE = 0x100000
+# blocks queued between two threads of a Pipeline
+PIPELINE_DEPTH = 4
+COPY_CHUNK_SIZE = 0x4000000
+# roms of at least PARALLEL_CRC_MIN bytes on a file have their crc32 computed in
+# chunks of at least PARALLEL_CRC_CHUNK bytes by several processes, see crc32_plan()
+PARALLEL_CRC_MIN = 0x10000000
+PARALLEL_CRC_CHUNK = 0x4000000
+
+# Linux only, used for zero-copy extraction
+libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import fcntl
+        libc = CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (ImportError, OSError):
+        libc = None
+
+FICLONERANGE = 0x4020940D
+
+ROM_PATTERN = "*.[3zZ][dDiI][sSpP]"
+
+# --watch: seconds between two listings when polling, and seconds a file must be
+# left unchanged before it is used when no close event tells it is complete
+WATCH_INTERVAL = 2.0
+WATCH_SETTLE = 2.0
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+CACHE_DIR = "cache"
+# where the CIAs are written and the xorpads looked for, see setup() to change them
+CIA_DIR = "cia"
+XORPAD_DIR = "xorpads"
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS xorpad_sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS xorpads (titleid TEXT, crc32 INTEGER, partition TEXT, section TEXT, source TEXT, member TEXT);
+CREATE INDEX IF NOT EXISTS xorpads_source ON xorpads (source);
+CREATE TABLE IF NOT EXISTS catalog (path TEXT, member TEXT, size INTEGER, mtime REAL, titleid TEXT, product_code TEXT,
+                                    crc32 INTEGER, partitions TEXT, encrypted INTEGER, seed INTEGER, PRIMARY KEY (path, member));
+CREATE TABLE IF NOT EXISTS crc32_cache (path TEXT, member TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, crc32 INTEGER,
+                                        PRIMARY KEY (path, member));
+CREATE TABLE IF NOT EXISTS outputs (crc32 INTEGER, size INTEGER, xorpad TEXT, converter TEXT, cia TEXT, cia_size INTEGER,
+                                    cia_mtime REAL, PRIMARY KEY (crc32, size, xorpad, converter));
+CREATE TABLE IF NOT EXISTS journal (path TEXT, member TEXT, size INTEGER, mtime REAL, converter TEXT, step TEXT, data TEXT,
+                                    PRIMARY KEY (path, member, step));
+CREATE TABLE IF NOT EXISTS ncchinfo_batches (output TEXT, filename TEXT);
+"""
+
+# titleid[.crc32].partition.section.xorpad
+XORPAD_NAME = re.compile(r"^([0-9a-fA-F]{16})(?:\.([0-9a-fA-F]{8}))?\.([^.]+)\.([^.]+)\.xorpad$", re.IGNORECASE)
+
+# The xorpad pack, in the xorpads directory, keeps the part of the xorpads the
+# conversions use, see import_xorpads(). It starts with XORPAD_PACK_MAGIC and
+# records are appended to it: blobs (tag, size, SHA-256, then the data) and keys
+# (tag, titleid, crc32, has crc32, partition, section, offset of the blob record).
+XORPAD_PACK = "xorpads.pack"
+XORPAD_PACK_MAGIC = b"3DSXPAK1"
+XORPAD_PACK_BLOB = struct.Struct("<4sI32s")
+XORPAD_PACK_KEY = struct.Struct("<4s16sIB16s16sQ")
+# (partition, section) -> bytes kept in the pack, the conversions only read the
+# start of the exheader xorpad. The other xorpads are only recorded as present.
+XORPAD_PACKED_SIZES = {("main", "exheader"): 0x400}
+
+# options of ncchinfo_gen() used for the roms missing their xorpads, see generate_ncchinfo()
+NCCHINFO_OPTIONS = {}
+
+# Part of the key of the CIAs in the output cache, to be bumped whenever the CIAs built change
+OUTPUT_VERSION = 1
+# convert every rom, even the ones whose CIA is in the output cache
+FORCE = False
+
+# (titleid, crc32, partition, section) -> (path, zip member), see load_xorpad_index()
+xorpad_index = None
+
+CERTCHAIN_FILE = "certchain.bin"
+# certificate chain used to build CIAs in process, see load_certchain()
+certchain = None
+# make_cia, used when there is no certificate chain
+make_cia = None
+# scratch space of the jobs
+tmpdir = None
+# in CACHE_DIR, the token of the conversion service, see serve()
+SERVICE_TOKEN_FILE = "service.token"
+# record the progress of the conversions in the journal, see Journal. Their
+# scratch space is then kept in WORK_DIR until they are done. Unless RESUME is
+# set, what an interrupted conversion of a rom left is discarded when it starts
+# again.
+JOURNAL = False
+RESUME = False
+WORK_DIR = "work"
+# subdirectory of the --scratch directory used as WORK_DIR
+SCRATCH_SUBDIR = "3ds-to-cia-work"
+# jobs needing up to RAM_SCRATCH_MAX bytes of scratch space have it in
+# RAM_WORK_DIR, on a tmpfs, when there is room there, see ScratchSpace. Those
+# are not journaled, they are cheap to extract again.
+# SCRATCH_MARGIN bytes are left free on every filesystem written to.
+RAM_WORK_DIR = os.path.join("/dev/shm", "3ds-to-cia-%d" % os.getuid()) if os.path.isdir("/dev/shm") else None
+RAM_SCRATCH_MAX = 512 * 1024 * 1024
+SCRATCH_MARGIN = 64 * 1024 * 1024
+# journal of the conversion run by the current job
+journal = None
+# archive or stream the CIAs go to instead of CIA_DIR, see open_sink()
+output_sink = None
+
+# stage -> timings and byte counts of the current job, see timed()
+stage_stats = None
+
+CIA_HEADER_SIZE = 0x2020
+CIA_TICKET_SIZE = 0x350
+TICKET_ISSUER = b"Root-CA00000003-XS0000000c"
+TMD_ISSUER = b"Root-CA00000003-CP0000000b"
+# Size of the signature block (type, signature and padding) starting tickets and TMDs, by signature type
+SIGNATURE_SIZES = {0x10000: 0x240, 0x10001: 0x140, 0x10002: 0x80, 0x10003: 0x240, 0x10004: 0x140, 0x10005: 0x80}
+# Ticket content index enabling every content
+TICKET_CONTENT_INDEX = binascii.unhexlify(b"00010014000000AC000000140001001400000000000000280000000100000084000000840003000000000000") + \
+    b"\xFF" * 0x80
+
 # Taked from ncchinfo_gen_exh.py (https://github.com/d0k3/Decrypt9WIP)
 mediaUnitSize = 0x200
 
@@ -111,7 +268,92 @@ def reverseCtypeArray(ctypeArray): #Reverses a ctype array and converts it to a
     return ''.join('%02X' % x for x in ctypeArray[::-1])
     #Is there a better way to do this?
 
-def ncchinfo_gen(files):
+# Headers of a NCSD (or of a single NCCH) rom, each one parsed once and only when needed.
+# The headers are mapped straight from the file when possible.
+class RomImage(object):
+    __slots__ = ("fh", "_map", "_ncsd", "_ncch", "_magic")
+
+    def __init__(self, fh):
+        self.fh = fh
+        self._ncsd = None
+        self._ncch = {}
+        self._magic = None
+        try:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (AttributeError, IOError, EnvironmentError, ValueError, OverflowError, mmap.error):
+            # not a real file, empty, or too big for a 32-bit address space
+            self._map = None
+
+    # the headers already returned must not be used after this
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _header(self, type, offset):
+        size = sizeof(type)
+        if self._map is not None and offset + size <= len(self._map):
+            return type.from_buffer(self._map, offset)
+        self.fh.seek(offset)
+        return type.from_buffer_copy(self.fh.read(size).ljust(size, b"\x00"))
+
+    @property
+    def magic(self):
+        if self._magic is None:
+            self._magic = self._header(ncchHdr, 0).magic
+        return self._magic
+
+    @property
+    def ncsd(self):
+        if self._ncsd is None:
+            self._ncsd = self._header(ncsdHdr, 0)
+        return self._ncsd
+
+    # NCCH header of partition i, the rom itself when it is a single NCCH
+    def ncch(self, i=0):
+        if i not in self._ncch:
+            self._ncch[i] = self._header(ncchHdr, self.partition_offset(i))
+        return self._ncch[i]
+
+    def partition_offset(self, i):
+        if self.magic != b'NCSD':
+            return 0
+        return self.ncsd.offset_sizeTable[i].offset * mediaUnitSize
+
+    # (index, offset, size) of the partitions, in bytes
+    @property
+    def partitions(self):
+        if self.magic != b'NCSD':
+            return [(0, 0, self.ncch().ncchSize * mediaUnitSize)]
+        table = self.ncsd.offset_sizeTable
+        return [(i, table[i].offset * mediaUnitSize, table[i].size * mediaUnitSize)
+                for i in xrange(len(table)) if table[i].offset]
+
+    # offset of the CXI, the first partition
+    @property
+    def cxi_offset(self):
+        partitions = self.partitions
+        return partitions[0][1] if partitions else 0
+
+    @property
+    def titleid(self):
+        return reverseCtypeArray(self.ncsd.titleId if self.magic == b'NCSD' else self.ncch().titleId)
+
+    def flag7(self, i=0):
+        return bytearray(self.ncch(i).flags)[7]
+
+    def product_code(self, i=0):
+        return str(bytearray(self.ncch(i).productCode)).rstrip('\x00')
+
+# Write the ncchinfo entries of the sections of files, a list of (filename, crc32), to output.
+# Entries whose xorpad is in the xorpad index and duplicate entries are skipped. When there
+# are more than max_entries entries or max_mb MB of xorpads they are split in several files
+# named after output ("ncchinfo-1.bin", "ncchinfo-2.bin", ...). Returns the files written.
+def ncchinfo_gen(files, output="ncchinfo.bin", sections=("exheader",), max_entries=None, max_mb=None):
+    def log(line=''):
+        if VERBOSE:
+            print line
+
     def roundUp(numToRound, multiple):  #From http://stackoverflow.com/a/3407254
         if (multiple == 0):
             return numToRound
@@ -143,9 +385,8 @@ def ncchinfo_gen(files):
         return bytes(counter)
 
     def parseNCSD(fh, crc32):
-        print 'Parsing NCSD in file "%s":' % os.path.basename(fh.name)
-        entries = 0
-        data = ''
+        log('Parsing NCSD in file "%s":' % os.path.basename(fh.name))
+        entries = []
 
         fh.seek(0)
         header = ncsdHdr()
@@ -153,19 +394,16 @@ def ncchinfo_gen(files):
 
         for i in xrange(len(header.offset_sizeTable)):
             if header.offset_sizeTable[i].offset:
-                result = parseNCCH(fh, crc32, header.offset_sizeTable[i].offset * mediaUnitSize, i, reverseCtypeArray(header.titleId), 0)
-                entries += result[0]
-                data = data + result[1]
-        return [entries, data]
+                entries += parseNCCH(fh, crc32, header.offset_sizeTable[i].offset * mediaUnitSize, i, reverseCtypeArray(header.titleId), 0)
+        return entries
 
     def parseNCCH(fh, crc32, offs=0, idx=0, titleId='', standAlone=1):
         tab = '    ' if not standAlone else '  '
         if not standAlone:
-            print '  Parsing %s NCCH' % ncsdPartitions[idx]
+            log('  Parsing %s NCCH' % ncsdPartitions[idx])
         else:
-            print 'Parsing NCCH in file "%s":' % os.path.basename(fh.name)
-        entries = 0
-        data = ''
+            log('Parsing NCCH in file "%s":' % os.path.basename(fh.name))
+        entries = []
 
         fh.seek(offs)
         header = ncchHdr()
@@ -177,31 +415,46 @@ def ncchinfo_gen(files):
         keyY = bytearray(header.signature[:16])
 
         if not standAlone:
-            print tab + 'NCCH Offset: %08X' % offs
-        print tab + 'Product code: ' + str(bytearray(header.productCode)).rstrip('\x00')
+            log(tab + 'NCCH Offset: %08X' % offs)
+        log(tab + 'Product code: ' + str(bytearray(header.productCode)).rstrip('\x00'))
         if not standAlone:
-            print tab + 'Partition number: %d' % idx
-        print tab + 'KeyY: %s' % binascii.hexlify(keyY).upper()
-        print tab + 'Title ID: %s' % reverseCtypeArray(header.titleId)
-        print tab + 'Format version: %d' % header.formatVersion
+            log(tab + 'Partition number: %d' % idx)
+        log(tab + 'KeyY: %s' % binascii.hexlify(keyY).upper())
+        log(tab + 'Title ID: %s' % reverseCtypeArray(header.titleId))
+        log(tab + 'Format version: %d' % header.formatVersion)
 
         fixed_key_flag = 0
         ncchFlag7 = bytearray(header.flags)[7]
         if ncchFlag7 == 0x1:
             fixed_key_flag = ncchFlag7
-            print tab + 'Uses fixed crypto key'
-
-        print ''
-
-        if header.exhdrSize:
-            data = data + parseNCCHSection(header, ncchSection.exheader, 0, fixed_key_flag, 1, tab)
-            data = data + genOutName(titleId, crc32, ncsdPartitions[idx], b'exheader')
-            entries += 1
-            print ''
-
-        print ''
-
-        return [entries, data]
+            log(tab + 'Uses fixed crypto key')
+        uses7xCrypto = bytearray(header.flags)[3]
+
+        log()
+
+        def addEntry(type, ncchFlag3, sectionName):
+            key = (titleId.upper(), crc32, ncsdPartitions[idx].lower(), sectionName)
+            index = xorpad_index or {}
+            if key in seen or key in index or key[:1] + (None,) + key[2:] in index:
+                return
+            seen.add(key)
+            sectionMb, entry = parseNCCHSection(header, type, ncchFlag3, fixed_key_flag, 1, tab)
+            entries.append((sectionMb, entry + genOutName(titleId, crc32, ncsdPartitions[idx], sectionName)))
+            log()
+
+        if header.exhdrSize and 'exheader' in sections:
+            addEntry(ncchSection.exheader, 0, b'exheader')
+        # 7.x crypto needs a second ExeFS xorpad, for .code
+        if header.exefsSize and 'exefs' in sections:
+            addEntry(ncchSection.exefs, 0, b'exefs_norm')
+            if uses7xCrypto:
+                addEntry(ncchSection.exefs, uses7xCrypto, b'exefs_7x')
+        if header.romfsSize and 'romfs' in sections:
+            addEntry(ncchSection.romfs, uses7xCrypto, b'romfs')
+
+        log()
+
+        return entries
 
     def parseNCCHSection(header, type, ncchFlag3, ncchFlag7, doPrint, tab):
         if type == ncchSection.exheader:
@@ -229,12 +482,12 @@ def ncchinfo_gen(files):
             sectionMb = 1 #Should never happen, but meh.
 
         if doPrint:
-            print tab + '%s offset:  %08X' % (sectionName, offset)
-            print tab + '%s counter: %s' % (sectionName, binascii.hexlify(counter))
-            print tab + '%s bytes: %d' % (sectionName, sectionSize)
-            print tab + '%s Megabytes(rounded up): %d' % (sectionName, sectionMb)
+            log(tab + '%s offset:  %08X' % (sectionName, offset))
+            log(tab + '%s counter: %s' % (sectionName, binascii.hexlify(counter)))
+            log(tab + '%s bytes: %d' % (sectionName, sectionSize))
+            log(tab + '%s Megabytes(rounded up): %d' % (sectionName, sectionMb))
 
-        return struct.pack('<16s16sIIIIQ', str(counter), str(keyY), sectionMb, 0, ncchFlag7, ncchFlag3, titleId)
+        return sectionMb, struct.pack('<16s16sIIIIQ', str(counter), str(keyY), sectionMb, 0, ncchFlag7, ncchFlag3, titleId)
 
     def genOutName(titleId, crc32, partitionName, sectionName):
         outName = b'/%s.%08lx.%s.%s.xorpad' % (titleId, crc32, partitionName, sectionName)
@@ -244,44 +497,393 @@ def ncchinfo_gen(files):
 
         return outName + (b'\x00'*(112-len(outName))) #Pad out so whole entry is 160 bytes (48 bytes are set before filename)
 
-    print ''
+    log()
 
-    entries = 0
-    data = ''
+    seen = set()
+    entries = []
 
     for file in files:
-        result = []
         filename, crc32 = file
 
         with open(filename,'rb') as fh:
             fh.seek(0x100)
             magic = fh.read(4)
             if magic == b'NCSD':
-                result = parseNCSD(fh, crc32)
-                print ''
+                entries += parseNCSD(fh, crc32)
+                log()
             elif magic == b'NCCH':
-                result = parseNCCH(fh, crc32)
-                print ''
-
-        if result:
-            entries += result[0]
-            data = data + result[1]
-
-    with open('ncchinfo.bin', 'wb') as fh:
-        fh.write(struct.pack('<IIII', 0xFFFFFFFF, 0xF0000004, entries, 0))
-        fh.write(data)
-
-    print 'Done!'
+                entries += parseNCCH(fh, crc32)
+                log()
+
+    # split the entries in batches, an entry bigger than max_mb gets its own batch
+    batches = [[]]
+    batchMb = 0
+    for sectionMb, entry in entries:
+        batch = batches[-1]
+        if batch and ((max_entries and len(batch) >= max_entries) or (max_mb and batchMb + sectionMb > max_mb)):
+            batch = []
+            batches.append(batch)
+            batchMb = 0
+        batch.append((sectionMb, entry))
+        batchMb += sectionMb
+
+    # the batches written by a previous run must not be mixed with the new ones,
+    # only the files it recorded are removed
+    base, ext = os.path.splitext(output)
+    db = open_cache()
+    try:
+        with db:
+            for (filename,) in db.execute("SELECT filename FROM ncchinfo_batches WHERE output = ?", (os.path.abspath(output),)):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            db.execute("DELETE FROM ncchinfo_batches WHERE output = ?", (os.path.abspath(output),))
+    finally:
+        db.close()
+
+    outputs = []
+    for i, batch in enumerate(batches):
+        filename = output
+        if len(batches) > 1:
+            filename = '%s-%d%s' % (base, i + 1, ext)
+        data = bytearray(struct.pack('<IIII', 0xFFFFFFFF, 0xF0000004, len(batch), 0))
+        for sectionMb, entry in batch:
+            data += entry
+        with open(filename, 'wb') as fh:
+            fh.write(data)
+        print '%s: %d entries, %d MB of xorpads' % (filename, len(batch), sum(sectionMb for sectionMb, entry in batch))
+        outputs.append(filename)
+
+    if len(outputs) > 1:
+        db = open_cache()
+        try:
+            with db:
+                db.executemany("INSERT INTO ncchinfo_batches VALUES (?, ?)",
+                               [(os.path.abspath(output), os.path.abspath(filename)) for filename in outputs])
+        finally:
+            db.close()
+    return outputs
+
+# Blocks of CHUNK_SIZE bytes read from the current position of fh, up to size bytes when given
+def read_blocks(fh, size=None):
+    while size is None or size > 0:
+        buf = fh.read(CHUNK_SIZE if size is None else min(size, CHUNK_SIZE))
+        if not buf: break
+        if size is not None:
+            size -= len(buf)
+        yield buf
+
+# Marks the end of the blocks in a pipeline queue
+PIPELINE_END = object()
+
+class PipelineAborted(Exception):
+    pass
+
+# Streams blocks through threads linked by queues of at most depth blocks: the
+# source is read in its own thread, then each stage added runs in its own thread
+# and passes on what it returns, and the last one (the sink) runs in the calling
+# thread. A stage facing a full queue waits for the next one (backpressure).
+# File I/O, hashlib and zlib release the GIL while they work on a block, so the
+# stages overlap. binascii.crc32 does not on Python 2.
+# The counters tell, for each stage, the blocks and bytes it handled and the
+# seconds it spent busy, starved (waiting for a block) and blocked (waiting for room).
+class Pipeline(object):
+    def __init__(self, name, depth=None):
+        self.name = name
+        self.depth = depth or PIPELINE_DEPTH
+        self.stages = []
+        self.counters = collections.OrderedDict()
+        self.error = None
+        self.aborted = False
+
+    def _counter(self, name):
+        return self.counters.setdefault(name, {"blocks": 0, "bytes": 0, "busy": 0.0, "starved": 0.0, "blocked": 0.0})
+
+    def add(self, name, func):
+        self.stages.append((name, func))
+        self._counter(name)
+        return self
+
+    def _put(self, queue, block, counter):
+        start = time.time()
+        while not self.aborted:
+            try:
+                queue.put(block, True, 0.1)
+                break
+            except Queue.Full:
+                pass
+        counter["blocked"] += time.time() - start
+        if self.aborted:
+            raise PipelineAborted()
+
+    def _get(self, queue, counter):
+        start = time.time()
+        while not self.aborted:
+            try:
+                block = queue.get(True, 0.1)
+                break
+            except Queue.Empty:
+                pass
+        counter["starved"] += time.time() - start
+        if self.aborted:
+            raise PipelineAborted()
+        return block
+
+    def _fail(self):
+        if self.error is None:
+            self.error = sys.exc_info()
+        self.aborted = True
+
+    def _feed(self, source, queue, counter):
+        try:
+            blocks = iter(source)
+            while True:
+                start = time.time()
+                block = next(blocks, PIPELINE_END)
+                counter["busy"] += time.time() - start
+                self._put(queue, block, counter)
+                if block is PIPELINE_END:
+                    break
+                counter["blocks"] += 1
+                counter["bytes"] += len(block)
+        except PipelineAborted:
+            pass
+        except BaseException:
+            self._fail()
+
+    def _work(self, func, inqueue, outqueue, counter):
+        try:
+            while True:
+                block = self._get(inqueue, counter)
+                if block is not PIPELINE_END:
+                    start = time.time()
+                    counter["blocks"] += 1
+                    counter["bytes"] += len(block)
+                    block = func(block)
+                    counter["busy"] += time.time() - start
+                self._put(outqueue, block, counter)
+                if block is PIPELINE_END:
+                    break
+        except PipelineAborted:
+            pass
+        except BaseException:
+            self._fail()
+
+    # Yield the blocks coming out of the last stage
+    def iterate(self, source, name="read"):
+        queues = [Queue.Queue(self.depth) for i in xrange(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0], self._counter(name)))]
+        for i, (stage, func) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._work, args=(func, queues[i], queues[i + 1], self.counters[stage])))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        done = False
+        try:
+            counter = {"starved": 0.0}
+            while True:
+                block = self._get(queues[-1], counter)
+                if block is PIPELINE_END:
+                    break
+                yield block
+            done = True
+        except PipelineAborted:
+            pass
+        finally:
+            if not done:
+                self.aborted = True
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    # Pass the blocks of source through the stages to sink, then add the counters to the stage timings
+    def run(self, source, name, sink):
+        counter = self._counter(name)
+        blocks = self.iterate(source)
+        try:
+            while True:
+                start = time.time()
+                block = next(blocks, PIPELINE_END)
+                counter["starved"] += time.time() - start
+                if block is PIPELINE_END:
+                    break
+                start = time.time()
+                sink(block)
+                counter["busy"] += time.time() - start
+                counter["blocks"] += 1
+                counter["bytes"] += len(block)
+        finally:
+            blocks.close()
+            self.record()
+
+    def record(self):
+        if stage_stats is None:
+            return
+        for stage, counter in self.counters.items():
+            entry = stage_stats.setdefault(self.name + "." + stage, new_stage_entry())
+            entry["calls"] += 1
+            entry["seconds"] += counter["busy"]
+            entry["starved_seconds"] += counter["starved"]
+            entry["blocked_seconds"] += counter["blocked"]
+            entry["bytes_written" if stage == "write" else "bytes_read"] += counter["bytes"]
+
+# File-like reading size bytes of fh ahead of the reads, in a pipeline thread.
+# It can only move forward, seeking far ahead starts reading again from there.
+class ReadAhead(object):
+    def __init__(self, fh, size, name):
+        self.fh = fh
+        self.name = name
+        self.end = fh.tell() + size
+        self.pipeline = Pipeline(name)
+        self.blocks = self.pipeline.iterate(read_blocks(fh, size))
+        self.buf = b""
+        self.offset = 0
+        self.position = fh.tell()
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset == len(self.buf):
+                self.buf = next(self.blocks, b"")
+                self.offset = 0
+                if not self.buf:
+                    break
+            count = len(self.buf) - self.offset if size < 0 else min(size, len(self.buf) - self.offset)
+            parts.append(self.buf if count == len(self.buf) else self.buf[self.offset:self.offset + count])
+            self.offset += count
+            self.position += count
+            size -= count
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset -= self.position
+        elif whence != os.SEEK_CUR:
+            raise IOError("cannot seek from the end")
+        if offset < 0:
+            raise IOError("cannot seek backward")
+        # beyond the blocks read ahead (partitions skipped when resuming a build)
+        if offset > CHUNK_SIZE * (PIPELINE_DEPTH + 2):
+            self.close()
+            self.fh.seek(self.position + offset)
+            self.__init__(self.fh, self.end - self.position - offset, self.name)
+            return
+        while offset > 0:
+            offset -= len(read_exactly(self, min(offset, CHUNK_SIZE)))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.blocks.close()
+        self.pipeline.record()
+
+# File-like writing to out in a thread, through a queue of PIPELINE_DEPTH blocks.
+# Seeking waits for the pending writes.
+class WriteBehind(object):
+    def __init__(self, out, name):
+        self.out = out
+        self.pipeline = Pipeline(name)
+        self.counter = self.pipeline._counter("write")
+        self.position = out.tell()
+        self.queue = Queue.Queue(PIPELINE_DEPTH)
+        self.thread = None
+
+    def _write(self):
+        counter = self.counter
+        try:
+            while True:
+                start = time.time()
+                block = self.queue.get()
+                counter["starved"] += time.time() - start
+                if block is PIPELINE_END:
+                    break
+                start = time.time()
+                self.out.write(block)
+                counter["busy"] += time.time() - start
+                counter["blocks"] += 1
+                counter["bytes"] += len(block)
+        except BaseException:
+            self.pipeline._fail()
+            # keep taking the blocks so that write() never waits forever
+            while self.queue.get() is not PIPELINE_END:
+                pass
+
+    def write(self, buf):
+        if self.pipeline.error is not None:
+            self.flush()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write)
+            self.thread.daemon = True
+            self.thread.start()
+        start = time.time()
+        self.queue.put(buf)
+        self.counter["blocked"] += time.time() - start
+        self.position += len(buf)
+
+    # Wait for the pending writes, raising their error if any
+    def flush(self):
+        if self.thread is not None:
+            self.queue.put(PIPELINE_END)
+            self.thread.join()
+            self.thread = None
+        error = self.pipeline.error
+        if error is not None:
+            self.pipeline.error = None
+            raise error[0], error[1], error[2]
+        self.out.flush()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.flush()
+        self.out.seek(offset, whence)
+        self.position = self.out.tell()
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pipeline.record()
 
 # Apply a xorpad
 def xor(bytes, xorpad):
     if len(bytes) > len(xorpad):
         raise Exception("xorpad is too small")
 
-    result = b""
-    for x in range(len(bytes)):
-        result += struct.pack("B", bytes[x] ^ xorpad[x])
-    return bytearray(result)
+    size = len(bytes)
+    if size == 0:
+        return bytearray()
+
+    if numpy is not None:
+        result = numpy.bitwise_xor(numpy.frombuffer(buffer(bytes), numpy.uint8, size),
+                                   numpy.frombuffer(buffer(xorpad), numpy.uint8, size))
+        return bytearray(result.tostring())
+
+    # xor the whole buffer at once as a big integer
+    result = int(binascii.hexlify(bytes), 16) ^ int(binascii.hexlify(xorpad[:size]), 16)
+    return bytearray(binascii.unhexlify("%0*x" % (size * 2, result)))
+
+# Apply a xorpad file to a region of a file, CHUNK_SIZE bytes at a time.
+# The result is written to out (at its current position) or back in place when out is None
+def xor_file(fh, offset, size, xorpad_fh, out=None):
+    xorpad_fh.seek(0)
+    position = offset
+    while size > 0:
+        fh.seek(position)
+        buf = bytearray(fh.read(min(size, CHUNK_SIZE)))
+        if not buf:
+            raise Exception("unexpected end of file")
+        buf = xor(buf, bytearray(xorpad_fh.read(len(buf))))
+        if out is None:
+            fh.seek(position)
+            fh.write(buf)
+        else:
+            out.write(buf)
+        position += len(buf)
+        size -= len(buf)
 
 # Calculate the sha256 of a string
 def sha256(s):
@@ -290,56 +892,214 @@ def sha256(s):
     return h.digest()
 
 # Verify is the xorpad is the correct one
-def verify_xorpad(fh, xorpad_file):
-    offset = 0
-    fh.seek(0x100)
-    magic = fh.read(4)
-    if magic == b'NCSD':
-        fh.seek(0)
-        header = ncsdHdr()
-        fh.readinto(header) #Reads header into structure
-        for i in xrange(len(header.offset_sizeTable)):
-            if header.offset_sizeTable[i].offset:
-                offset = header.offset_sizeTable[i].offset * \
-                    mediaUnitSize
-                break
+def verify_xorpad(fh, xorpad_ref):
+    rom = RomImage(fh)
+    offset = rom.cxi_offset
+    rom.close()
 
     # get exheader
     fh.seek(offset + 0x200)
     exheader = bytearray(fh.read(0x400))
     # decrypt exheader when needed
-    if not xorpad_file is None:
-        xorpad = bytearray(open(xorpad_file, "rb").read(0x400))
+    if not xorpad_ref is None:
+        xorpad = read_xorpad(xorpad_ref, 0x400)
         exheader = xor(exheader, xorpad)
     # verify exheader sha256sum
     fh.seek(offset + 0x160)
     orig_sha256 = fh.read(0x20)
     return sha256(exheader) == orig_sha256
 
-# Extract rom
-def extract_rom(fh):
+# Clone the block aligned part of a range (btrfs, XFS, ...), returns the bytes cloned
+def reflink_range(fh, offset, size, fw, dst_offset):
+    blksize = os.fstat(fh.fileno()).st_blksize
+    size -= size % blksize
+    if libc is None or offset % blksize or dst_offset % blksize or size == 0:
+        return 0
+    fcntl.ioctl(fw.fileno(), FICLONERANGE, struct.pack("<qQQQ", fh.fileno(), offset, size, dst_offset))
+    return size
+
+def copy_file_range(fh, offset, size, fw, dst_offset):
+    if libc is None or not hasattr(libc, "copy_file_range"):
+        return 0
+    libc.copy_file_range.restype = c_ssize_t
+    off_in = c_int64(offset)
+    off_out = c_int64(dst_offset)
+    copied = 0
+    while copied < size:
+        ret = libc.copy_file_range(fh.fileno(), byref(off_in), fw.fileno(), byref(off_out), c_size_t(min(size - copied, COPY_CHUNK_SIZE)), 0)
+        if ret < 0:
+            err = get_errno()
+            raise OSError(err, os.strerror(err))
+        if ret == 0: break
+        copied += ret
+    return copied
+
+def sendfile_range(fh, offset, size, fw, dst_offset):
+    if libc is None or not hasattr(libc, "sendfile64"):
+        return 0
+    libc.sendfile64.restype = c_ssize_t
+    off_in = c_int64(offset)
+    os.lseek(fw.fileno(), dst_offset, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        ret = libc.sendfile64(fw.fileno(), fh.fileno(), byref(off_in), c_size_t(min(size - copied, COPY_CHUNK_SIZE)))
+        if ret < 0:
+            err = get_errno()
+            raise OSError(err, os.strerror(err))
+        if ret == 0: break
+        copied += ret
+    return copied
+
+def mmap_range(fh, offset, size, fw, dst_offset):
+    fw.seek(dst_offset)
+    end = min(offset + size, os.fstat(fh.fileno()).st_size)
+    position = offset
+    while position < end:
+        start = position - position % mmap.ALLOCATIONGRANULARITY
+        length = min(end - start, COPY_CHUNK_SIZE)
+        m = mmap.mmap(fh.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+        try:
+            fw.write(m[position - start:length])
+        finally:
+            m.close()
+        position = start + length
+    return position - offset
+
+def buffered_range(fh, offset, size, fw, dst_offset):
+    fh.seek(offset)
+    fw.seek(dst_offset)
+    copied = 0
+    while copied < size:
+        buf = fh.read(min(size - copied, COPY_CHUNK_SIZE))
+        if not buf: break
+        fw.write(buf)
+        copied += len(buf)
+    return copied
+
+COPY_METHODS = [
+    ("reflink", reflink_range),
+    ("copy_file_range", copy_file_range),
+    ("sendfile", sendfile_range),
+    ("mmap", mmap_range),
+    ("buffered", buffered_range),
+]
+
+# Copy a range of fh at the start of fw using the fastest method that works,
+# falling back to the next ones for what is left. Returns the methods used
+def copy_range(fh, offset, size, fw):
+    used = []
+    copied = 0
+    for name, method in COPY_METHODS:
+        try:
+            done = method(fh, offset + copied, size - copied, fw, copied)
+        except (IOError, OSError, EnvironmentError, ValueError, mmap.error):
+            continue
+        if done:
+            used.append(name)
+            copied += done
+        if copied >= size:
+            break
+    return used
+
+# (file, offset of the rom in it) giving direct access to the rom of fh, None
+# for a compressed zip member
+def rom_file_range(fh):
+    if isinstance(fh, ZipMemberReader):
+        return fh.raw_range()
+    return fh, 0
+
+def rom_size(fh):
+    if isinstance(fh, ZipMemberReader):
+        return fh.info.file_size
+    return os.fstat(fh.fileno()).st_size
+
+# Extract rom partitions with copy_range(), returns the methods used. Stored zip
+# members are copied straight from the archive.
+def copy_rom(fh, workdir, done=(), checkpoint=None):
     fh.seek(0)
     header = ncsdHdr()
     fh.readinto(header) #Reads header into structure
+    raw, base = rom_file_range(fh)
+
+    used = []
     for i in xrange(6):
-        if header.offset_sizeTable[i].offset:
+        if header.offset_sizeTable[i].offset and i not in done:
             ext = ".cxi" if i == 0 else ".cfa"
-            fh.seek(header.offset_sizeTable[i].offset * mediaUnitSize)
-            with open(os.path.join(tmpdir, str(i) + ext), "wb") as fw:
-                for j in xrange(header.offset_sizeTable[i].size):
-                    buf = fh.read(mediaUnitSize)
-                    fw.write(buf)
+            with open(os.path.join(workdir, str(i) + ext), "wb", 0) as fw:
+                for method in copy_range(raw, base + header.offset_sizeTable[i].offset * mediaUnitSize,
+                                         header.offset_sizeTable[i].size * mediaUnitSize, fw):
+                    if method not in used:
+                        used.append(method)
+            if checkpoint is not None:
+                checkpoint(i, fw.name)
+    return used
+
+# Extract rom. When the crc32 is already known the partitions are copied with
+# the fastest method available, otherwise (or for compressed zip members) they
+# are split in a single pass while computing the crc32. The partitions in done
+# are already extracted, checkpoint(i, filename) is called once partition i is.
+# Returns the crc32 of the rom, the sha256 of the partitions (when hashed) and the methods used
+def extract_rom(fh, workdir, crc32=None, done=(), checkpoint=None):
+    if crc32 is not None and rom_file_range(fh) is not None:
+        return crc32, {}, copy_rom(fh, workdir, done, checkpoint)
+
+    crc32, hashes = split_rom(fh, workdir, done, checkpoint)
+    return crc32, hashes, ["single pass"]
+
+# Extract rom in a single pass over the whole file.
+# Returns the crc32 of the rom and the sha256 of every extracted partition
+def split_rom(fh, workdir, done=(), checkpoint=None):
+    fh.seek(0)
+    header = ncsdHdr()
+    fh.readinto(header) #Reads header into structure
+
+    partitions = []
+    for i in xrange(6):
+        if header.offset_sizeTable[i].offset and i not in done:
+            ext = ".cxi" if i == 0 else ".cfa"
+            start = header.offset_sizeTable[i].offset * mediaUnitSize
+            end = start + header.offset_sizeTable[i].size * mediaUnitSize
+            fw = open(os.path.join(workdir, str(i) + ext), "wb")
+            partitions.append((i, start, end, fw, hashlib.sha256()))
+
+    # the crc32 is computed in its own thread, while the partitions are hashed and written
+    state = {"crc32": 0, "position": 0}
+    def update_crc32(buf):
+        state["crc32"] = binascii.crc32(buf, state["crc32"])
+        return buf
+
+    def write(buf):
+        position = state["position"]
+        for i, start, end, fw, h in partitions:
+            if start < position + len(buf) and end > position:
+                begin = max(start - position, 0)
+                chunk = buffer(buf, begin, min(end - position, len(buf)) - begin)
+                fw.write(chunk)
+                h.update(chunk)
+                if end <= position + len(buf) and checkpoint is not None:
+                    fw.close()
+                    checkpoint(i, fw.name)
+        state["position"] = position + len(buf)
+
+    fh.seek(0)
+    try:
+        Pipeline("split").add("crc", update_crc32).run(read_blocks(fh), "write", write)
+    finally:
+        for i, start, end, fw, h in partitions:
+            fw.close()
+
+    return state["crc32"] & 0xFFFFFFFF, dict((i, h.digest()) for i, start, end, fw, h in partitions)
 
 
 # Set SD flag in exheader, updates SHA256 in CXI and returns the save data size (KB)
-def fix_cxi(filename, xorpad_file):
+def fix_cxi(filename, xorpad_ref):
     f = open(filename, "r+b")
     # get exheader
     f.seek(0x200)
     exheader = bytearray(f.read(0x400))
     # decrypt exheader when needed
-    if not xorpad_file is None:
-        xorpad = bytearray(open(xorpad_file, "rb").read(0x400))
+    if not xorpad_ref is None:
+        xorpad = read_xorpad(xorpad_ref, 0x400)
         exheader = xor(exheader, xorpad)
     # set sd flag in exheader
     exh_flags = exheader[0xD]
@@ -353,118 +1113,1538 @@ def fix_cxi(filename, xorpad_file):
     # return save data size to be used on make_cia
     save_data_size = struct.unpack("<Q", exheader[0x1C0:0x1C8])[0] / 1024
     # reencrypt exheader when needed
-    if not xorpad_file is None:
+    if not xorpad_ref is None:
         exheader = xor(exheader, xorpad)
     f.write(exheader)
     return save_data_size
 
-def get_titleid(fh):
-    fh.seek(0)
-    header = ncsdHdr()
-    fh.readinto(header) #Reads header into structure
-    return reverseCtypeArray(header.titleId)
-
-def get_ncchFlag7(fh):
-    fh.seek(0)
-    header = ncsdHdr()
-    fh.readinto(header) #Reads header into structure
-
-    fh.seek(header.offset_sizeTable[0].offset * mediaUnitSize)
-    header = ncchHdr()
-    fh.readinto(header) #Reads header into structure
+def align(size, alignment=0x40):
+    return size + (-size % alignment)
 
-    ncchFlag7 = bytearray(header.flags)[7]
-    return ncchFlag7
+def read_exactly(fh, size):
+    buf = fh.read(size)
+    if len(buf) != size:
+        raise IOError("unexpected end of file")
+    return buf
 
-def find_xorpad(titleid, crc32):
-    expectedname = "%s.%08lx.Main.exheader.xorpad" % (titleid, crc32)
-    legacyname = titleid + ".Main.exheader.xorpad"
-
-    xorpads = glob.glob(os.path.join("xorpads", "*.[xX][oO][rR][pP][aA][dD]"))
-    xorpads += glob.glob(os.path.join("xorpads", "*.[zZ][iI][pP]"))
-
-    for xorpad in xorpads:
-        if zipfile.is_zipfile(xorpad):
-            with zipfile.ZipFile(xorpad, "r") as e:
-                for entry in e.infolist():
-                    filename = os.path.join(tmpdir, expectedname)
-                    basename = os.path.basename(entry.filename)
-                    if basename.lower() == expectedname.lower():
-                        source = e.open(entry, "r")
-                        target = file(filename, "wb")
-                        with source, target:
-                            shutil.copyfileobj(source, target)
-                        return filename
+# Move forward in fh, reading and dropping data when it cannot seek (zip members)
+def skip(fh, size):
+    if size < 0:
+        raise IOError("partitions are not in offset order")
+    try:
+        fh.seek(size, os.SEEK_CUR)
+    except (IOError, AttributeError):
+        while size > 0:
+            size -= len(read_exactly(fh, min(size, CHUNK_SIZE)))
+
+# Copy the part of buf, found at position, that falls in [start, start + len(into)) to into
+def capture(buf, position, start, into):
+    begin = max(start, position)
+    end = min(start + len(into), position + len(buf))
+    if begin < end:
+        into[begin - start:end - start] = buf[begin - position:end - position]
+
+# Signature block of a fake signed ticket or TMD (RSA-2048 SHA-256)
+def cia_signature():
+    return struct.pack(">I", 0x10004) + b"\xFF" * 0x100 + b"\x00" * 0x3C
+
+def cia_ticket(titleid, version):
+    ticket = cia_signature()
+    ticket += TICKET_ISSUER.ljust(0x40, b"\x00")
+    ticket += b"\x00" * 0x3C                 # ECC public key
+    ticket += struct.pack(">BBB", 1, 0, 0)    # version, CA and signer CRL versions
+    ticket += b"\x00" * 0x10                 # title key
+    ticket += b"\x00"
+    ticket += struct.pack(">QIQ", 0, 0, titleid)  # ticket id, console id, title id
+    ticket += b"\x00" * 2
+    ticket += struct.pack(">H", version)
+    ticket += b"\x00" * 8
+    ticket += struct.pack(">BB", 0, 0)        # license type, common key index
+    ticket += b"\x00" * 0x2A
+    ticket += struct.pack(">I", 0)            # eShop account id
+    ticket += struct.pack(">BB", 0, 1)        # audit
+    ticket += b"\x00" * 0x42
+    ticket += b"\x00" * 0x40                 # limits
+    ticket += TICKET_CONTENT_INDEX
+    return ticket
+
+def cia_tmd_size(count):
+    return 0xB04 + 0x30 * count
+
+# records are (content id, index, type, size, sha256) tuples
+def cia_tmd(titleid, version, save_data_size, records):
+    chunks = b"".join(struct.pack(">IHHQ", content_id, index, content_type, size) + digest
+                      for content_id, index, content_type, size, digest in records)
+    infos = struct.pack(">HH", 0, len(records)) + sha256(chunks)
+    infos = infos.ljust(0x24 * 64, b"\x00")
+
+    tmd = cia_signature()
+    tmd += TMD_ISSUER.ljust(0x40, b"\x00")
+    tmd += struct.pack(">BBBB", 1, 0, 0, 0)   # version, CA and signer CRL versions
+    tmd += struct.pack(">QQIH", 0, titleid, 0x40, 0)  # system version, title id, title type, group id
+    tmd += struct.pack("<II", save_data_size, 0)
+    tmd += b"\x00" * 4
+    tmd += b"\x00" * 0x32                    # SRL flag
+    tmd += struct.pack(">IHHHH", 0, version, len(records), 0, 0)  # access rights, title version, content count, boot content
+    tmd += sha256(infos)
+    return tmd + infos + chunks
+
+def cia_meta(exheader, icon):
+    meta = bytes(exheader[0x40:0x1C0])       # dependency list
+    meta += b"\x00" * 0x180
+    meta += bytes(exheader[0x208:0x20C])      # core version
+    meta += b"\x00" * 0xFC
+    return meta + bytes(icon)
+
+def cia_header(certchain, ticket, tmd, meta, content_size, indexes):
+    bitfield = bytearray(0x2000)
+    for index in indexes:
+        bitfield[index / 8] |= 0x80 >> (index % 8)
+    header = struct.pack("<IHHIIIIQ", CIA_HEADER_SIZE, 0, 0, len(certchain), len(ticket), len(tmd), len(meta), content_size)
+    return header + bytes(bitfield)
+
+# Title id and partitions of a rom read from the start of fh, the partitions as
+# (offset, size, index) tuples in offset order, the CXI first
+def read_partitions(fh):
+    ncsd = ncsdHdr.from_buffer_copy(read_exactly(fh, sizeof(ncsdHdr)))
+    titleid = struct.unpack("<Q", bytearray(ncsd.titleId))[0]
+    partitions = sorted((ncsd.offset_sizeTable[i].offset * mediaUnitSize, ncsd.offset_sizeTable[i].size * mediaUnitSize, i)
+                        for i in xrange(6) if ncsd.offset_sizeTable[i].offset)
+    if not partitions or partitions[0][2] != 0:
+        raise IOError("no CXI partition found")
+    return titleid, partitions
+
+# Stream the partitions of a rom from fh, positioned after its NCSD header, to
+# write when given, hashing them when hashed is set. The CXI exheader is verified
+# and fixed like fix_cxi() does. Returns the content records (without hashes when
+# hashed is not set) and what the ticket, TMD and meta need, or None when the
+# exheader hash does not match.
+# checkpoint(n, step) is called once the nth partition is written, step holding
+# what is needed to skip it. The first partitions are skipped (not read nor
+# written) with the steps in resumed.
+def stream_contents(fh, partitions, xorpad, write, hashed=True, resumed=(), checkpoint=None):
+    position = sizeof(ncsdHdr)
+    records = []
+    for n, (start, size, index) in enumerate(partitions):
+        skip(fh, start - position)
+        position = start
+        if n < len(resumed):
+            step = resumed[n]
+            content_id, content_index, content_type, content_size, digest = step["record"]
+            records.append((content_id, content_index, content_type, content_size, binascii.unhexlify(digest)))
+            if index == 0:
+                version, save_data_size = step["version"], step["save_data_size"]
+                cxi_exheader = bytearray(binascii.unhexlify(step["exheader"]))
+                icon = bytearray(binascii.unhexlify(step["icon"]))
+            continue
+        h = hashlib.sha256() if hashed else None
+        done = 0
+
+        if index == 0:
+            first = bytearray(read_exactly(fh, 0x600))
+            ncch = ncchHdr.from_buffer_copy(bytes(first[:0x200]))
+            exheader = first[0x200:0x600]
+            if xorpad is not None:
+                exheader = xor(exheader, xorpad)
+            if sha256(exheader) != bytes(first[0x160:0x180]):
+                return None
+            # set sd flag in exheader and reset the hash
+            exheader[0xD] |= 2
+            first[0x160:0x180] = sha256(exheader)
+            # the remaster version is the major version of the title
+            version = (struct.unpack("<H", bytes(exheader[0xE:0x10]))[0] << 10) & 0xFFFF
+            save_data_size = struct.unpack("<Q", bytes(exheader[0x1C0:0x1C8]))[0]
+            first[0x200:0x600] = exheader if xorpad is None else xor(exheader, xorpad)
+            cxi_exheader = exheader
+
+            # the icon can only be read from a NoCrypto ExeFS
+            exefs_start = ncch.exefsOffset * mediaUnitSize
+            exefs_header = bytearray(0x200) if bytearray(ncch.flags)[7] & 0x4 and ncch.exefsSize else None
+            icon_start = None
+            icon = bytearray(0x36C0)
+
+            buf = bytes(first)
         else:
-            basename = os.path.basename(xorpad)
-            if basename.lower() == expectedname.lower() or \
-               basename.lower() == legacyname.lower():
+            buf = fh.read(min(size, CHUNK_SIZE))
+
+        while buf:
+            if write is not None:
+                write(buf)
+            if h is not None:
+                h.update(buf)
+            if index == 0 and exefs_header is not None:
+                capture(buf, done, exefs_start, exefs_header)
+                if icon_start is None and done + len(buf) >= exefs_start + 0x200:
+                    for j in xrange(10):
+                        name, offset, length = struct.unpack_from("<8sII", bytes(exefs_header), j * 0x10)
+                        if name.rstrip(b"\x00") == b"icon":
+                            icon_start = exefs_start + 0x200 + offset
+                            icon = icon[:min(length, len(icon))]
+                    if icon_start is None:
+                        exefs_header = None
+                if icon_start is not None:
+                    capture(buf, done, icon_start, icon)
+            done += len(buf)
+            position += len(buf)
+            buf = fh.read(min(size - done, CHUNK_SIZE)) if done < size else b""
+        if done != size:
+            raise IOError("unexpected end of file")
+
+        records.append((index, index, 0, size, h.digest() if h is not None else None))
+        if checkpoint is not None:
+            step = {"record": list(records[-1][:4]) + [binascii.hexlify(records[-1][4])]}
+            if index == 0:
+                step.update(version=version, save_data_size=save_data_size, exheader=binascii.hexlify(cxi_exheader),
+                            icon=binascii.hexlify(icon))
+            checkpoint(n, step)
+
+    return {"records": records, "version": version, "save_data_size": save_data_size, "exheader": cxi_exheader,
+            "icon": icon.ljust(0x36C0, b"\x00")}
+
+# Header, ticket, TMD and meta of the CIA of a title with contents (see stream_contents())
+def cia_sections(titleid, contents, certchain):
+    records = contents["records"]
+    meta = cia_meta(contents["exheader"], contents["icon"])
+    ticket = cia_ticket(titleid, contents["version"])
+    tmd = cia_tmd(titleid, contents["version"], contents["save_data_size"], records)
+    header = cia_header(certchain, ticket, tmd, meta, sum(record[3] for record in records), [record[1] for record in records])
+    return header, ticket, tmd, meta
+
+# Build a CIA from a rom read sequentially from fh, the contents are streamed
+# from the rom partitions and hashed on the way. out must be seekable, the
+# header, ticket and TMD are written last. The CXI exheader is verified and
+# fixed like fix_cxi() does. resumed and checkpoint let an interrupted build go on
+# with out, see stream_contents().
+# Returns the content records or None when the exheader hash does not match
+def build_cia(fh, out, xorpad_ref, certchain, resumed=(), checkpoint=None):
+    titleid, partitions = read_partitions(fh)
+    xorpad = None
+    if xorpad_ref is not None:
+        xorpad = read_xorpad(xorpad_ref, 0x400)
+
+    content_offset = align(CIA_HEADER_SIZE) + align(len(certchain)) + align(CIA_TICKET_SIZE) + \
+        align(cia_tmd_size(len(partitions)))
+    out.seek(content_offset + sum(step["record"][3] for step in resumed))
+    contents = stream_contents(fh, partitions, xorpad, out.write, True, resumed, checkpoint)
+    if contents is None:
+        return None
 
-                return xorpad
+    header, ticket, tmd, meta = cia_sections(titleid, contents, certchain)
+    out.seek(align(out.tell()))
+    out.write(meta)
+    out.seek(0)
+    for section in (header, certchain, ticket, tmd):
+        out.write(section)
+        out.seek(align(out.tell()))
+    return contents["records"]
+
+# Build a CIA written in order to a writer that cannot seek: a first pass over
+# the rom hashes the contents for the TMD, the second one writes them after the
+# header, ticket and TMD. open_rom() returns the rom read from its start, for
+# each pass, and open_output(size) the writer of the CIA (see SinkEntry), closed
+# once the CIA is written and aborted on errors. Returns the content records or
+# None when the exheader hash does not match (before opening the writer).
+def stream_cia(open_rom, open_output, xorpad_ref, certchain):
+    xorpad = None
+    if xorpad_ref is not None:
+        xorpad = read_xorpad(xorpad_ref, 0x400)
+    with contextlib.closing(open_rom()) as fh:
+        titleid, partitions = read_partitions(fh)
+        contents = stream_contents(fh, partitions, xorpad, None)
+    if contents is None:
+        return None
 
-def convert_to_cia(filename, crc32):
+    header, ticket, tmd, meta = cia_sections(titleid, contents, certchain)
+    sections = [section + b"\x00" * (-len(section) % 0x40) for section in (header, certchain, ticket, tmd)]
+    content_size = sum(record[3] for record in contents["records"])
+    out = open_output(sum(len(section) for section in sections) + align(content_size) + len(meta))
+    try:
+        for section in sections:
+            out.write(section)
+        with contextlib.closing(open_rom()) as fh:
+            read_partitions(fh)
+            if stream_contents(fh, partitions, xorpad, out.write, False) is None:
+                raise IOError("the rom changed during the conversion")
+        out.write(b"\x00" * (-content_size % 0x40))
+        out.write(meta)
+    except BaseException:
+        out.abort()
+        raise
+    out.close()
+    return contents["records"]
+
+# Output sinks take the CIAs when they do not go to files in the cia directory:
+# into an archive, or to a stream. open(name, size) returns the SinkEntry the
+# CIA of size bytes is written to, in order. The entries written are listed,
+# with their size and SHA-256, in entries.
+class SinkEntry(object):
+    def __init__(self, sink, name, size, out):
+        self.sink = sink
+        self.name = name
+        self.size = size
+        self.written = 0
+        self.hash = hashlib.sha256()
+        # the sink writes (and compresses) in its own thread
+        self.out = WriteBehind(out, sink.name)
+
+    def write(self, buf):
+        self.hash.update(buf)
+        self.written += len(buf)
+        self.out.write(buf)
+
+    def close(self):
+        self.out.close()
+        if self.written != self.size:
+            raise IOError("%s is %d bytes instead of %d" % (self.name, self.written, self.size))
+        self.sink.finish(self)
+        self.sink.entries.append({"cia": self.name, "size": self.written, "sha256": self.hash.hexdigest()})
+
+    def abort(self):
+        try:
+            self.out.close()
+        except Exception:
+            pass
+        self.sink.discard(self)
+
+# Counts what goes through to fh, whose position may not be known (stdout, pipes)
+class CountingWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.position = 0
+
+    def write(self, buf):
+        self.fh.write(buf)
+        self.position += len(buf)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        # the stream of a tar archive cannot be flushed, it is once the archive is closed
+        if hasattr(self.fh, "flush"):
+            self.fh.flush()
+
+# A single CIA written as is to a stream: stdout or a named pipe
+class StreamSink(object):
+    name = "stream"
+
+    def __init__(self, fh, target):
+        self.fh = fh
+        self.target = target
+        self.entries = []
+        self.broken = False
+
+    def open(self, name, size):
+        if self.entries or self.broken:
+            raise IOError("only one CIA can be written to " + self.target)
+        return SinkEntry(self, name, size, CountingWriter(self.fh))
+
+    def finish(self, entry):
+        pass
+
+    def discard(self, entry):
+        self.broken = True
+
+    def add_file(self, name, filename):
+        add_file(self, name, filename)
+
+    def close(self):
+        if self.fh is not sys.__stdout__:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+# Deflates what goes through to the archive file of a zip entry, computing its CRC32
+class ZipEntryWriter(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.crc32 = 0
+        self.position = 0
+        self.compress_size = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def write(self, buf):
+        self.crc32 = zlib.crc32(buf, self.crc32)
+        self.position += len(buf)
+        buf = self.compressor.compress(buf)
+        self.compress_size += len(buf)
+        self.fp.write(buf)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        buf = self.compressor.flush()
+        self.compress_size += len(buf)
+        self.fp.write(buf)
+
+# CIAs deflated into a zip archive. zipfile can only add files or strings, so the
+# entries are written like ZipFile.write() does, the local header being
+# written again once the CRC32 and sizes are known. The archive file must be seekable.
+class ZipSink(object):
+    name = "zip"
+
+    def __init__(self, target):
+        self.target = target
+        self.archive = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, True)
+        self.entries = []
+
+    def open(self, name, size):
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16L
+        info.file_size = size
+        info.CRC = info.compress_size = 0
+        info.header_offset = self.archive.fp.tell()
+        self.archive._writecheck(info)
+        self.archive._didModify = True
+        zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+        self.archive.fp.write(info.FileHeader(zip64))
+        entry = SinkEntry(self, name, size, ZipEntryWriter(self.archive.fp))
+        entry.info = info
+        entry.zip64 = zip64
+        return entry
+
+    def finish(self, entry):
+        info = entry.info
+        writer = entry.out.out
+        writer.finish()
+        info.CRC = writer.crc32 & 0xFFFFFFFF
+        info.compress_size = writer.compress_size
+        if not entry.zip64 and info.compress_size > zipfile.ZIP64_LIMIT:
+            raise IOError("%s does not compress in a zip without zip64 extensions" % entry.name)
+        fp = self.archive.fp
+        position = fp.tell()
+        fp.seek(info.header_offset)
+        fp.write(info.FileHeader(entry.zip64))
+        fp.seek(position)
+        self.archive.filelist.append(info)
+        self.archive.NameToInfo[info.filename] = info
+
+    # the next entry overwrites what was written of the entry
+    def discard(self, entry):
+        self.archive.fp.seek(entry.info.header_offset)
+        self.archive.fp.truncate()
+
+    def add_file(self, name, filename):
+        add_file(self, name, filename)
+
+    def close(self):
+        self.archive.close()
+
+# CIAs stored in a tar archive, compressed with gzip or bzip2 by extension. The
+# archive is written as a stream and can go to a named pipe.
+class TarSink(object):
+    name = "tar"
+
+    def __init__(self, target):
+        self.target = target
+        lower = target.lower()
+        compression = "gz" if lower.endswith((".tar.gz", ".tgz")) else "bz2" if lower.endswith((".tar.bz2", ".tbz2")) else ""
+        self.archive = tarfile.open(target, "w|" + compression)
+        self.entries = []
+        self.broken = False
+
+    def open(self, name, size):
+        if self.broken:
+            raise IOError("%s is incomplete after an error" % self.target)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0644
+        # written like TarFile.addfile() does, the data coming from the entry
+        header = info.tobuf(self.archive.format, self.archive.encoding, self.archive.errors)
+        self.archive.fileobj.write(header)
+        self.archive.offset += len(header)
+        entry = SinkEntry(self, name, size, CountingWriter(self.archive.fileobj))
+        entry.info = info
+        return entry
+
+    def finish(self, entry):
+        remainder = entry.size % tarfile.BLOCKSIZE
+        if remainder:
+            self.archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        self.archive.offset += align(entry.size, tarfile.BLOCKSIZE)
+        self.archive.members.append(entry.info)
+
+    def discard(self, entry):
+        self.broken = True
+
+    def add_file(self, name, filename):
+        add_file(self, name, filename)
+
+    def close(self):
+        self.archive.close()
+
+# Copy the CIA filename (built by make_cia) to sink as name
+def add_file(sink, name, filename):
     with open(filename, "rb") as fh:
-        titleid = get_titleid(fh)
-        ncchFlag7 = get_ncchFlag7(fh)
-        decrypted = ncchFlag7 & 0x4
-        new_keyY = ncchFlag7 & 0x20
-
-        xorpad_file = None if decrypted else find_xorpad(titleid, crc32)
+        entry = sink.open(name, os.fstat(fh.fileno()).st_size)
+        try:
+            for buf in read_blocks(fh):
+                entry.write(buf)
+        except BaseException:
+            entry.abort()
+            raise
+        entry.close()
+
+# The sink for the --output target: a zip or tar archive, "-" for stdout or a
+# named pipe. None for a directory, where the CIAs are written as files.
+def open_sink(target):
+    lower = target.lower()
+    if target == "-":
+        # colorama may have wrapped sys.stdout, which would strip escape sequences from the CIA
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.setmode(sys.__stdout__.fileno(), os.O_BINARY)
+        return StreamSink(sys.__stdout__, "stdout")
+    elif lower.endswith(".zip"):
+        return ZipSink(target)
+    elif lower.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2")):
+        return TarSink(target)
+    elif os.path.exists(target) and stat.S_ISFIFO(os.stat(target).st_mode):
+        return StreamSink(open(target, "wb"), target)
+    return None
 
-        if verify_xorpad(fh, xorpad_file) == False:
-            if decrypted:
-                print "Xorpad file is not valid."
-            else:
-                print "Rom corrupted."
-            return False
+# The certificate chain (CA00000003, XS0000000c and CP0000000b certificates)
+# needed to build CIAs in process, found in the working directory, next to
+# 3ds-to-cia or with the tools. None when it is not available
+def load_certchain():
+    for path in [".", os.path.dirname(os.path.abspath(__file__)), get_tools_path()]:
+        filename = os.path.join(path or ".", CERTCHAIN_FILE)
+        if os.path.isfile(filename):
+            with open(filename, "rb") as fh:
+                return fh.read()
+    return None
 
-        if VERBOSE:
-            fstdout = sys.stdout
-            fstderr = sys.stderr
+# Save the certificate chain of an existing CIA to certchain.bin
+def extract_certchain(ciafile, filename=CERTCHAIN_FILE):
+    with open(ciafile, "rb") as fh:
+        header_size, type, version, certchain_size = struct.unpack("<IHHI", read_exactly(fh, 12))
+        fh.seek(align(header_size))
+        certchain = read_exactly(fh, certchain_size)
+    with open(filename, "wb") as fh:
+        fh.write(certchain)
+
+# Check the exheader of a CXI, first being its first 0x600 bytes, is left as
+# fix_cxi() writes it: its hash in the NCCH header matches and the SD flag is
+# set. Encrypted exheaders are tried with every exheader xorpad of the title.
+# Returns "ok", "hash mismatch", "no sd flag", "not a cxi" or "no xorpad"
+def check_exheader(first, titleid):
+    if len(first) < 0x600:
+        return "not a cxi"
+    ncch = ncchHdr.from_buffer_copy(bytes(first[:sizeof(ncchHdr)]))
+    if ncch.magic != b"NCCH":
+        return "not a cxi"
+    exheader = bytearray(first[0x200:0x600])
+    if bytearray(ncch.flags)[7] & 0x4:
+        candidates = [None]
+    else:
+        if xorpad_index is None:
+            load_xorpad_index()
+        candidates = [ref for key, ref in sorted(xorpad_index.items()) if key[0] == titleid and key[2:] == ("main", "exheader")]
+        if not candidates:
+            return "no xorpad"
+
+    for ref in candidates:
+        decrypted = exheader if ref is None else xor(exheader, read_xorpad(ref, 0x400))
+        if sha256(decrypted) == bytes(bytearray(ncch.exhdrHash)):
+            return "ok" if decrypted[0xD] & 2 else "no sd flag"
+    return "hash mismatch"
+
+# Check a CIA: its header and TMD are parsed, then the file is read once, in
+# order, and the SHA-256 of every content checked against its TMD chunk record
+# (but for encrypted contents). The exheader of the CXI is checked with check_exheader().
+# Returns the result, its status is "ok" or "invalid" (the reasons are in errors)
+def verify_cia(filename):
+    result = {"cia": filename, "size": None, "titleid": None, "contents": [], "exheader": None, "errors": []}
+    start = time.time()
+    try:
+        with open(filename, "rb") as raw:
+            result["size"] = os.fstat(raw.fileno()).st_size
+            fh = ReadAhead(raw, result["size"], "verify")
+            try:
+                verify_cia_file(fh, result)
+            finally:
+                result["bytes_read"] = fh.tell()
+                fh.close()
+    except (IOError, OSError, struct.error), e:
+        result["errors"].append(str(e))
+    result["status"] = "invalid" if result["errors"] else "ok"
+    result["seconds"] = round(time.time() - start, 6)
+    return result
+
+# Parse and hash the CIA read from fh for verify_cia(), adding what is found to result
+def verify_cia_file(fh, result):
+    errors = result["errors"]
+
+    header = read_exactly(fh, CIA_HEADER_SIZE)
+    header_size, type, version, certchain_size, ticket_size, tmd_size, meta_size, content_size = \
+        struct.unpack_from("<IHHIIIIQ", header)
+    if header_size != CIA_HEADER_SIZE:
+        raise IOError("not a CIA")
+    indexes = bytearray(header[0x20:])
+    tmd_offset = align(align(align(header_size) + certchain_size) + ticket_size)
+    content_offset = align(tmd_offset + tmd_size)
+    content_end = content_offset + content_size
+    if result["size"] < (align(content_end) + meta_size if meta_size else content_end):
+        errors.append("the file is truncated")
+
+    skip(fh, tmd_offset - fh.tell())
+    tmd = read_exactly(fh, tmd_size)
+    signature_size = SIGNATURE_SIZES.get(struct.unpack_from(">I", tmd)[0])
+    if signature_size is None:
+        raise IOError("unknown TMD signature type")
+    titleid = struct.unpack_from(">Q", tmd, signature_size + 0x4C)[0]
+    result["titleid"] = "%016X" % titleid
+    count = struct.unpack_from(">H", tmd, signature_size + 0x9E)[0]
+    infos = tmd[signature_size + 0xC4:signature_size + 0xC4 + 0x24 * 64]
+    chunks = tmd[signature_size + 0xC4 + 0x24 * 64:]
+    if len(chunks) < 0x30 * count:
+        raise IOError("the TMD is truncated")
+    if sha256(infos) != tmd[signature_size + 0xA4:signature_size + 0xC4]:
+        errors.append("content info records hash mismatch")
+    # each content info record hashes a run of chunk records
+    for i in xrange(64):
+        offset, records, digest = struct.unpack_from(">HH32s", infos, i * 0x24)
+        if records and sha256(chunks[offset * 0x30:(offset + records) * 0x30]) != digest:
+            errors.append("content info record %d hash mismatch" % i)
+
+    skip(fh, content_offset - fh.tell())
+    for i in xrange(count):
+        content_id, index, content_type, size, digest = struct.unpack_from(">IHHQ32s", chunks, i * 0x30)
+        content = {"id": content_id, "index": index, "size": size, "encrypted": bool(content_type & 1)}
+        result["contents"].append(content)
+        if not indexes[index / 8] & (0x80 >> (index % 8)):
+            errors.append("content %d is missing from the header index" % index)
+        if fh.tell() + size > content_end:
+            content["status"] = "truncated"
+            errors.append("content %d is outside of the content section" % index)
+            break
+
+        h = hashlib.sha256()
+        first = fh.read(min(size, 0x600))
+        h.update(first)
+        done = len(first)
+        for buf in read_blocks(fh, size - done):
+            h.update(buf)
+            done += len(buf)
+        if done != size:
+            content["status"] = "truncated"
+            errors.append("content %d is truncated" % index)
+            break
+
+        content["sha256"] = h.hexdigest()
+        # the TMD has the hashes of the decrypted contents
+        if content_type & 1:
+            content["status"] = "encrypted"
+            continue
+        if h.digest() == digest:
+            content["status"] = "ok"
         else:
-            fstderr = fstdout = open(os.devnull, 'wb')
-
-        # Extract cxi and cfa
-        extract_rom(fh)
-
-        # Fix cxi
-        save_data_size = fix_cxi(glob.glob(os.path.join(tmpdir, "0.cxi"))[0], xorpad_file)
-
-        # Generate CIA file
-        contents = glob.glob(os.path.join(tmpdir, "*.[cC][xX][iI]"))
-        contents += glob.glob(os.path.join(tmpdir, "*.[cC][fF][aA]"))
-
-        # Generate make_cia command line
-        ciafilename = os.path.join("cia", os.path.splitext(os.path.basename(filename))[0]) + ".cia"
-
-        cmdline = ["-v", "-o", ciafilename, "--savesize=" + str(save_data_size)]
+            content["status"] = "hash mismatch"
+            errors.append("content %d hash mismatch" % index)
+        if index == 0:
+            result["exheader"] = check_exheader(first, result["titleid"])
+            if result["exheader"] not in ("ok", "no xorpad"):
+                errors.append("exheader: " + result["exheader"])
+
+# Open the cache database, creating the tables when needed
+def open_cache():
+    if not os.path.isdir(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+    db = sqlite3.connect(os.path.join(CACHE_DIR, "cache.db"))
+    db.text_factory = str
+    db.executescript(CACHE_SCHEMA)
+    return db
+
+# Progress of the conversion of a rom, kept in the cache database so that an
+# interrupted run can pick it up (--resume) at the first step not done. A step
+# is recorded with its JSON data once what it wrote is on disk. The steps are
+# forgotten when the rom or the converter change, or when resume is not set.
+# The scratch directory of the conversion is recorded as its "workdir" step.
+class Journal(object):
+    def __init__(self, path, member=None, resume=True):
+        st = os.stat(path)
+        self.key = (os.path.realpath(path), member or "")
+        self.signature = (st.st_size, st.st_mtime, converter_id())
+        db = open_cache()
+        try:
+            rows = db.execute("SELECT size, mtime, converter, step, data FROM journal WHERE path = ? AND member = ?",
+                              self.key).fetchall()
+        finally:
+            db.close()
+        self.steps = dict((step, json.loads(data)) for size, mtime, converter, step, data in rows
+                          if (size, mtime, converter) == self.signature)
+        if not resume or len(self.steps) != len(rows):
+            # what the previous conversion wrote is not used
+            for size, mtime, converter, step, data in rows:
+                if step == "workdir":
+                    shutil.rmtree(json.loads(data)["path"], True)
+            self.clear()
+
+    # The data of step, None when it is not done
+    def get(self, step):
+        return self.steps.get(step)
+
+    # Steps can be recorded by the threads of a pipeline, each record has its own connection
+    def record(self, step, data):
+        self.steps[step] = data
+        db = open_cache()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           self.key + self.signature + (step, json.dumps(data)))
+        finally:
+            db.close()
+
+    # Forget the steps done and remove the scratch directory they were done in
+    def discard(self):
+        if self.get("workdir") is not None:
+            shutil.rmtree(self.get("workdir")["path"], True)
+        self.clear()
+
+    def clear(self):
+        self.steps = {}
+        db = open_cache()
+        try:
+            with db:
+                db.execute("DELETE FROM journal WHERE path = ? AND member = ?", self.key)
+        finally:
+            db.close()
+
+# Scratch directory of the conversion of a rom in root (WORK_DIR by default), the
+# same from one run to the next
+def journal_workdir(path, member=None, root=None):
+    key = hashlib.sha1(os.path.realpath(path) + "\x00" + (member or "")).hexdigest()[:16]
+    return os.path.join(root or WORK_DIR, key)
+
+# Make sure what was written to filename is on disk before it is recorded in the journal
+def sync_file(filename):
+    with open(filename, "ab") as fh:
+        os.fsync(fh.fileno())
+
+# Move a CIA written under a temporary name into place, so that it is never seen half written
+def publish_cia(partname, ciafilename):
+    # rename() does not replace files on Windows
+    if sys.platform == "win32" and os.path.exists(ciafilename):
+        os.remove(ciafilename)
+    os.rename(partname, ciafilename)
+
+# Key of a rom (or of a .3ds inside a zip) in the crc32 cache
+def crc32_cache_key(path, member=None, size=None):
+    st = os.stat(path)
+    if size is None:
+        size = st.st_size
+    return (os.path.realpath(path), member or "", size, int(st.st_mtime * 1000000000), st.st_ino)
+
+# The cached crc32 of a rom, None when it is unknown or the file changed
+def cached_crc32(path, member=None, size=None):
+    key = crc32_cache_key(path, member, size)
+    db = open_cache()
+    try:
+        row = db.execute("SELECT crc32 FROM crc32_cache WHERE path = ? AND member = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                         key).fetchone()
+    finally:
+        db.close()
+    return None if row is None else row[0]
 
-        i = 0
-        for content in contents:
-            cmdline += ["--content" + str(i) + "=" + content, "--id_" + str(i) + "=" + str(i), "--index_" + str(i) + "=" + str(i)]
-            i += 1
+def store_crc32(path, crc32, member=None, size=None):
+    db = open_cache()
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO crc32_cache VALUES (?, ?, ?, ?, ?, ?)", crc32_cache_key(path, member, size) + (crc32,))
+    finally:
+        db.close()
+
+# crc32 of the rom read from fh. The ones on a file, big enough and on a disk
+# that is not rotational are split in chunks whose crc32 are computed by several
+# processes, binascii.crc32 holding the GIL on Python 2, then combined.
+def file_crc32(fh):
+    raw = rom_file_range(fh)
+    if raw is not None and os.path.isfile(getattr(raw[0], "name", "")):
+        size = rom_size(fh)
+        chunk_size, processes = crc32_plan(raw[0].name, size)
+        if processes > 1:
+            crc32 = parallel_crc32(raw[0].name, raw[1], size, chunk_size, processes)
+            if not isinstance(fh, ZipMemberReader):
+                fh.seek(0, os.SEEK_END)
+            return crc32
+
+    state = {"crc32": 0}
+    def update(buf):
+        state["crc32"] = binascii.crc32(buf, state["crc32"])
+    fh.seek(0)
+    Pipeline("crc").run(read_blocks(fh), "crc", update)
+    return state["crc32"] & 0xFFFFFFFF
 
-        # Generate CIA file
-        ret = subprocess.call([make_cia] + cmdline, stdout = fstdout, stderr = fstderr)
+# Whether the file at path is on a rotational disk, None when it is unknown (not
+# Linux, or not on a block device)
+def on_rotational_disk(path):
+    if not hasattr(os, "major") or not os.path.isdir("/sys/dev/block"):
+        return None
+    device = os.stat(path).st_dev
+    # a partition has no queue of its own, its disk has
+    block = "/sys/dev/block/%d:%d" % (os.major(device), os.minor(device))
+    for queue in (os.path.join(block, "queue"), os.path.join(block, "..", "queue")):
+        try:
+            with open(os.path.join(queue, "rotational")) as fh:
+                return fh.read().strip() == "1"
+        except IOError:
+            pass
+    return None
 
+# (chunk size, processes) for the crc32 of size bytes of the file at path. Small
+# roms are read faster than processes start, and parallel reads make a rotational
+# disk seek back and forth: they are read in a single pass. The jobs of a pool
+# already keep the CPUs busy and cannot start processes of their own.
+def crc32_plan(path, size):
+    processes = min(multiprocessing.cpu_count(), size / PARALLEL_CRC_CHUNK)
+    if size < PARALLEL_CRC_MIN or processes < 2 or multiprocessing.current_process().daemon or on_rotational_disk(path):
+        return size, 1
+    # a few chunks per process, so that none of them is left working alone at the end
+    chunk_size = max(size / (processes * 4), PARALLEL_CRC_CHUNK)
+    # whole blocks, that may be bigger than the chunks with a large --block-size
+    chunk_size += -chunk_size % CHUNK_SIZE
+    chunks = -(-size / chunk_size)
+    if chunks < 2:
+        return size, 1
+    return chunk_size, min(processes, chunks)
+
+# crc32 of a (path, offset, size) range of a file
+def crc32_range(args):
+    path, offset, size = args
+    crc32 = 0
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        for buf in read_blocks(fh, size):
+            crc32 = binascii.crc32(buf, crc32)
+    return crc32 & 0xFFFFFFFF
+
+# crc32 of size bytes at offset of the file at path, computed in chunks of
+# chunk_size bytes by processes processes and combined with crc32_combine()
+def parallel_crc32(path, offset, size, chunk_size, processes):
+    chunks = [(path, offset + start, min(chunk_size, size - start)) for start in xrange(0, size, chunk_size)]
+    pool = new_pool(min(processes, len(chunks)))
+    try:
+        # a timeout keeps the wait interruptible by Ctrl-C
+        crcs = pool.map_async(crc32_range, chunks).get(0xFFFF)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    crc32 = 0
+    for (path, start, length), chunk_crc32 in zip(chunks, crcs):
+        crc32 = crc32_combine(crc32, chunk_crc32, length)
+    return crc32
+
+# Product of a 32x32 GF(2) matrix, given as its columns, by a vector
+def gf2_matrix_times(matrix, vector):
+    product = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            product ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return product
+
+def gf2_matrix_square(matrix):
+    return [gf2_matrix_times(matrix, column) for column in matrix]
+
+# length -> operator running a crc32 through length zero bytes, see crc32_combine()
+crc32_operators = {}
+
+# crc32 of the concatenation of two blocks from the crc32 of each, the second
+# one being length bytes long, like zlib's crc32_combine(): crc1 is run through
+# length zero bytes. The operator doing it is the product of the squares of the
+# operator of a zero bit matching the bits of length, and is kept for the next
+# chunks of the same length.
+def crc32_combine(crc1, crc2, length):
+    if length <= 0:
+        return crc1
+    operator = crc32_operators.get(length)
+    if operator is None:
+        # operator of one zero bit, then of two and four zero bits
+        square = [0xEDB88320] + [1 << n for n in xrange(31)]
+        square = gf2_matrix_square(gf2_matrix_square(square))
+        operator = [1 << n for n in xrange(32)]
+        remaining = length
+        while remaining:
+            square = gf2_matrix_square(square)
+            if remaining & 1:
+                operator = [gf2_matrix_times(square, column) for column in operator]
+            remaining >>= 1
+        crc32_operators[length] = operator
+    return gf2_matrix_times(operator, crc1) ^ crc2
+
+# crc32 of a whole rom, only computed when it is not in the cache
+def rom_crc32(path):
+    crc32 = cached_crc32(path)
+    if crc32 is not None:
+        return crc32
+
+    with timed("crc") as record, open(path, "rb") as fh:
+        crc32 = file_crc32(fh)
+        record["read"] = fh.tell()
+    store_crc32(path, crc32)
+    return crc32
+
+# Parse a xorpad file name, returns (titleid, crc32, partition, section) or None.
+# crc32 is None for the legacy "titleid.Main.exheader.xorpad" naming
+def parse_xorpad_name(name):
+    m = XORPAD_NAME.match(os.path.basename(name))
+    if m is None:
+        return None
+    titleid, crc32, partition, section = m.groups()
+    return (titleid.upper(), None if crc32 is None else int(crc32, 16), partition.lower(), section.lower())
+
+# List the xorpads found in a loose file or a zip, as (key, member) tuples
+def scan_xorpad_source(path):
+    found = []
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path, "r") as e:
+            for entry in e.infolist():
+                key = parse_xorpad_name(entry.filename)
+                if key is not None:
+                    found.append((key, entry.filename))
+    else:
+        key = parse_xorpad_name(path)
+        if key is not None:
+            found.append((key, None))
+    return found
+
+# Build the xorpad index, mapping (titleid, crc32, partition, section) to
+# (path, zip member or None). The index is kept in the cache database and only
+# the xorpad files and zips whose mtime or size changed are scanned again.
+def load_xorpad_index(directory=None):
+    global xorpad_index
+    directory = directory or XORPAD_DIR
+
+    db = open_cache()
+    with db:
+        stored = {}
+        for path, mtime, size in db.execute("SELECT path, mtime, size FROM xorpad_sources"):
+            stored[path] = (mtime, size)
+
+        # the directory mtime only changes when files are added or removed
+        st = os.stat(directory)
+        if stored.get(directory) == (st.st_mtime, 0):
+            sources = [path for path in stored if path != directory]
+        else:
+            sources = glob.glob(os.path.join(directory, "*.[xX][oO][rR][pP][aA][dD]"))
+            sources += glob.glob(os.path.join(directory, "*.[zZ][iI][pP]"))
+            db.execute("INSERT OR REPLACE INTO xorpad_sources VALUES (?, ?, ?)", (directory, st.st_mtime, 0))
+
+        for path in set(stored) - set(sources) - set([directory]):
+            db.execute("DELETE FROM xorpad_sources WHERE path = ?", (path,))
+            db.execute("DELETE FROM xorpads WHERE source = ?", (path,))
+
+        for path in sources:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stored.get(path) == (st.st_mtime, st.st_size):
+                continue
+            db.execute("DELETE FROM xorpads WHERE source = ?", (path,))
+            db.executemany("INSERT INTO xorpads VALUES (?, ?, ?, ?, ?, ?)",
+                           [key + (path, member) for key, member in scan_xorpad_source(path)])
+            db.execute("INSERT OR REPLACE INTO xorpad_sources VALUES (?, ?, ?)", (path, st.st_mtime, st.st_size))
+
+        # loose files first, then zips, in name order, then the pack: a xorpad
+        # dropped in the directory replaces the one imported into the pack
+        index = {}
+        for row in db.execute("SELECT titleid, crc32, partition, section, source, member FROM xorpads "
+                              "ORDER BY member IS NOT NULL, source, member"):
+            index.setdefault(tuple(row[:4]), (row[4], row[5]))
+        pack = os.path.join(directory, XORPAD_PACK)
+        for key, offset in read_xorpad_pack(pack)[0].items():
+            index.setdefault(key, (pack, offset))
+    db.close()
+
+    xorpad_index = index
+    return index
+
+# Returns the (path, zip member) of the exheader xorpad of a rom, or None
+def lookup_xorpad(titleid, crc32):
+    if xorpad_index is None:
+        load_xorpad_index()
+
+    found = xorpad_index.get((titleid.upper(), crc32, "main", "exheader"))
+    if found is None:
+        found = xorpad_index.get((titleid.upper(), None, "main", "exheader"))
+    return found
+
+# Read the index of a xorpad pack: returns ({key: blob offset}, {SHA-256: blob
+# offset}, size of the valid records), a record cut short ends the pack
+def read_xorpad_pack(path):
+    keys, blobs = {}, {}
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+    except IOError:
+        return keys, blobs, 0
+    if not data.startswith(XORPAD_PACK_MAGIC):
+        return keys, blobs, 0
+
+    offset = len(XORPAD_PACK_MAGIC)
+    while True:
+        tag = data[offset:offset + 4]
+        if tag == b"BLOB" and offset + XORPAD_PACK_BLOB.size <= len(data):
+            tag, size, digest = XORPAD_PACK_BLOB.unpack_from(data, offset)
+            if offset + XORPAD_PACK_BLOB.size + size > len(data):
+                break
+            blobs[digest] = offset
+            offset += XORPAD_PACK_BLOB.size + size
+        elif tag == b"KEY " and offset + XORPAD_PACK_KEY.size <= len(data):
+            tag, titleid, crc32, has_crc32, partition, section, blob = XORPAD_PACK_KEY.unpack_from(data, offset)
+            key = (titleid, crc32 if has_crc32 else None, partition.rstrip(b"\x00"), section.rstrip(b"\x00"))
+            keys[key] = blob
+            offset += XORPAD_PACK_KEY.size
+        else:
+            break
+    return keys, blobs, offset
+
+# The data of the blob at offset in a xorpad pack, read with a single seek
+def read_packed_xorpad(path, offset):
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        buf = fh.read(XORPAD_PACK_BLOB.size + max(XORPAD_PACKED_SIZES.values()))
+        tag, size, digest = XORPAD_PACK_BLOB.unpack_from(buf)
+        if len(buf) < XORPAD_PACK_BLOB.size + size:
+            buf += read_exactly(fh, XORPAD_PACK_BLOB.size + size - len(buf))
+    return buf[XORPAD_PACK_BLOB.size:XORPAD_PACK_BLOB.size + size]
+
+# Import the xorpads of loose files and zips (or of the directories holding them)
+# into the pack of the xorpads directory, keeping XORPAD_PACKED_SIZES bytes of
+# each. The same data is only stored once. The sources whose xorpads were all
+# imported are removed when remove is set. Returns the counts of the import.
+def import_xorpads(paths, remove=False):
+    if not os.path.isdir(XORPAD_DIR):
+        os.mkdir(XORPAD_DIR)
+    pack = os.path.join(XORPAD_DIR, XORPAD_PACK)
+    keys, blobs, end = read_xorpad_pack(pack)
+    stats = {"sources": 0, "xorpads": 0, "stored": 0, "deduplicated": 0, "skipped": 0, "removed": 0,
+             "source_bytes": 0, "pack_bytes": 0}
+
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources += sorted(glob.glob(os.path.join(path, "*.[xX][oO][rR][pP][aA][dD]")))
+            sources += sorted(glob.glob(os.path.join(path, "*.[zZ][iI][pP]")))
+        else:
+            sources.append(path)
+
+    with open(pack, "r+b" if end else "wb") as fh:
+        # drop what an interrupted import left cut short
+        fh.seek(end)
+        fh.truncate()
+        if not end:
+            fh.write(XORPAD_PACK_MAGIC)
+
+        for path in sources:
+            found = scan_xorpad_source(path)
+            if not found:
+                continue
+            stats["sources"] += 1
+            stats["source_bytes"] += os.path.getsize(path)
+            imported = 0
+            for key, member in found:
+                titleid, crc32, partition, section = key
+                if len(partition) > 16 or len(section) > 16:
+                    print colorama.Fore.YELLOW + "Skipped %s: its name is too long" % (member or path)
+                    print colorama.Style.RESET_ALL
+                    stats["skipped"] += 1
+                    continue
+                size = XORPAD_PACKED_SIZES.get((partition, section), 0)
+                with contextlib.closing(open_xorpad((path, member))) as xorpad:
+                    data = xorpad.read(size)
+                if len(data) < size:
+                    print colorama.Fore.YELLOW + "Skipped %s: it is too small" % (member or path)
+                    print colorama.Style.RESET_ALL
+                    stats["skipped"] += 1
+                    continue
+
+                digest = sha256(data)
+                blob = blobs.get(digest)
+                if blob is None:
+                    blob = blobs[digest] = fh.tell()
+                    fh.write(XORPAD_PACK_BLOB.pack(b"BLOB", len(data), digest) + data)
+                    stats["stored"] += 1
+                else:
+                    stats["deduplicated"] += 1
+                if keys.get(key) != blob:
+                    keys[key] = blob
+                    fh.write(XORPAD_PACK_KEY.pack(b"KEY ", titleid, crc32 or 0, crc32 is not None, partition, section, blob))
+                stats["xorpads"] += 1
+                imported += 1
+
+            complete = imported == len(found)
+            if complete and zipfile.is_zipfile(path):
+                # a zip holding anything else is kept
+                with zipfile.ZipFile(path, "r") as e:
+                    complete = len([name for name in e.namelist() if not name.endswith("/")]) == len(found)
+            if remove and complete:
+                fh.flush()
+                os.fsync(fh.fileno())
+                if path in zip_archives:
+                    zip_archives.pop(path)[1].close()
+                os.remove(path)
+                stats["removed"] += 1
+        stats["pack_bytes"] = fh.tell()
+    return stats
+
+# Zip archives opened to read xorpads, by path, see open_archive(). The rom
+# archives are not kept open, see ZipRomReader.
+zip_archives = {}
+
+# The archive at path, opened once per run unless it changes
+def open_archive(path):
+    st = os.stat(path)
+    found = zip_archives.get(path)
+    if found is not None and found[0] == (st.st_size, st.st_mtime):
+        return found[1]
+    if found is not None:
+        found[1].close()
+    archive = zipfile.ZipFile(path, "r")
+    zip_archives[path] = ((st.st_size, st.st_mtime), archive)
+    return archive
+
+def close_archives():
+    for signature, archive in zip_archives.values():
+        archive.close()
+    zip_archives.clear()
+
+# Read only file-like access to a zip member (a xorpad or a rom) that only reads
+# what is asked for: stored members are read straight from the archive at their
+# offset, deflated ones are decompressed up to the position read. Reading them
+# forward is the fastest, seeking backward starts the decompression over.
+class ZipMemberReader(object):
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.info = archive.getinfo(member)
+        self.position = 0
+        self.offset = None
+        self.stream = None
+        self.stream_position = 0
+        if self.info.compress_type == zipfile.ZIP_STORED and not self.info.flag_bits & 0x1:
+            # data follows the local header, whose name and extra field lengths may differ from the central directory
+            archive.fp.seek(self.info.header_offset)
+            name_length, extra_length = struct.unpack("<26xHH", read_exactly(archive.fp, 30))
+            self.offset = self.info.header_offset + 30 + name_length + extra_length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.info.file_size
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        left = self.info.file_size - self.position
+        if size < 0 or size > left:
+            size = max(left, 0)
+        if self.offset is not None:
+            self.archive.fp.seek(self.offset + self.position)
+            buf = self.archive.fp.read(size)
+        else:
+            if self.stream is None or self.stream_position > self.position:
+                self.stream = self.archive.open(self.info, "r")
+                self.stream_position = 0
+            while self.stream_position < self.position:
+                skipped = len(self.stream.read(min(self.position - self.stream_position, CHUNK_SIZE)))
+                if not skipped:
+                    break
+                self.stream_position += skipped
+            buf = self.stream.read(size)
+            self.stream_position += len(buf)
+        self.position += len(buf)
+        return buf
+
+    # b is a bytearray or a ctypes structure, like the headers
+    def readinto(self, b):
+        if isinstance(b, Structure):
+            buf = self.read(sizeof(b))
+            memmove(addressof(b), buf, len(buf))
+        else:
+            buf = self.read(len(b))
+            b[:len(buf)] = buf
+        return len(buf)
+
+    # (archive file, offset of the data) of a stored member, None when it must be decompressed
+    def raw_range(self):
+        if self.offset is None:
+            return None
+        return self.archive.fp, self.offset
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+# Reader of a rom in the zip at path. Unlike the xorpad archives (see
+# open_archive()), the archive is opened for the rom alone and closed with it:
+# a batch of zipped roms does not keep a file open for every one of them.
+class ZipRomReader(ZipMemberReader):
+    def __init__(self, path, member):
+        archive = zipfile.ZipFile(path, "r")
+        try:
+            ZipMemberReader.__init__(self, archive, member)
+        except:
+            archive.close()
+            raise
+
+    def close(self):
+        ZipMemberReader.close(self)
+        self.archive.close()
+
+# Open a xorpad from its (path, zip member or None) reference, or (pack, blob offset)
+def open_xorpad(ref):
+    path, member = ref
+    if member is None:
+        return open(path, "rb")
+    if isinstance(member, (int, long)):
+        return io.BytesIO(read_packed_xorpad(path, member))
+    return ZipMemberReader(open_archive(path), member)
+
+# The first size bytes of a xorpad
+def read_xorpad(ref, size):
+    with contextlib.closing(open_xorpad(ref)) as fh:
+        return bytearray(fh.read(size))
+
+def print_invalid_xorpad(decrypted):
+    if decrypted:
+        print "Xorpad file is not valid."
+    else:
+        print "Rom corrupted."
+
+# Time a stage of the current job and add it to stage_stats. The caller sets the
+# "read" and "written" byte counts of the yielded record. Subprocess time is the
+# CPU time of the children waited for during the stage (make_cia).
+@contextlib.contextmanager
+def timed(stage):
+    record = {"read": 0, "written": 0}
+    start = time.time()
+    times = os.times()
+    try:
+        yield record
+    finally:
+        end = os.times()
+        if stage_stats is not None:
+            entry = stage_stats.setdefault(stage, new_stage_entry())
+            entry["calls"] += 1
+            entry["seconds"] += time.time() - start
+            entry["cpu_seconds"] += end[0] + end[1] - times[0] - times[1]
+            entry["subprocess_seconds"] += end[2] + end[3] - times[2] - times[3]
+            entry["bytes_read"] += record["read"]
+            entry["bytes_written"] += record["written"]
+
+# Pipeline stages also count the seconds they waited for a block (starved) or
+# for room in the next queue (blocked)
+def new_stage_entry():
+    return {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0, "subprocess_seconds": 0.0, "bytes_read": 0, "bytes_written": 0,
+            "starved_seconds": 0.0, "blocked_seconds": 0.0}
+
+# Add the stage entries of stages to the ones of total
+def add_stages(total, stages):
+    for stage, entry in stages.items():
+        entry_total = total.setdefault(stage, new_stage_entry())
+        for key in entry_total:
+            entry_total[key] += entry[key]
+    return total
+
+# Round the timings and add the throughput (MB/s of the larger of the bytes read or written)
+def finish_stages(stages):
+    result = collections.OrderedDict()
+    for stage, entry in stages.items():
+        entry = dict(entry)
+        size = max(entry["bytes_read"], entry["bytes_written"])
+        entry["mb_per_s"] = round(size / entry["seconds"] / (1024 * 1024), 2) if size and entry["seconds"] else None
+        # share of its time a pipeline stage was busy
+        waited = entry["starved_seconds"] + entry["blocked_seconds"]
+        entry["utilization"] = round(entry["seconds"] / (entry["seconds"] + waited), 3) if waited else None
+        for key in ["seconds", "cpu_seconds", "subprocess_seconds", "starved_seconds", "blocked_seconds"]:
+            entry[key] = round(entry[key], 6) or 0.0
+        result[stage] = entry
+    return result
+
+REPORT_FIELDS = ["rom", "entry", "status", "stage", "calls", "seconds", "cpu_seconds", "subprocess_seconds",
+                 "bytes_read", "bytes_written", "mb_per_s", "starved_seconds", "blocked_seconds", "utilization"]
+
+# Write the run report: the stages of the main loop, of every rom and their sum.
+# The format is CSV when filename ends with .csv, JSON otherwise.
+def write_report(filename, run_stages, results, seconds, jobs):
+    total = add_stages(collections.OrderedDict(), run_stages)
+    for result in results:
+        add_stages(total, result["stages"])
+
+    report = collections.OrderedDict()
+    report["started"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - seconds))
+    report["seconds"] = round(seconds, 6)
+    report["jobs"] = jobs
+    report["builder"] = "native" if certchain is not None else "make_cia"
+    report["roms"] = [dict(result, stages=finish_stages(result["stages"])) for result in results]
+    report["run"] = finish_stages(run_stages)
+    report["total"] = finish_stages(total)
+
+    if filename.lower().endswith(".csv"):
+        with open(filename, "wb") as fh:
+            writer = csv.DictWriter(fh, REPORT_FIELDS)
+            writer.writeheader()
+            rows = [(result, result["stages"]) for result in report["roms"]]
+            rows += [({"rom": "(run)"}, report["run"]), ({"rom": "(total)"}, report["total"])]
+            for result, stages in rows:
+                for stage, entry in stages.items():
+                    writer.writerow(dict(entry, rom=result["rom"], entry=result.get("entry") or "",
+                                         status=result.get("status", ""), stage=stage))
+    else:
+        with open(filename, "w") as fh:
+            json.dump(report, fh, indent=1)
+
+# Merge the profiles dumped by the workers into the one of the main process
+def save_profile(profiler, filename, results):
+    profiler.dump_stats(filename)
+    profiles = [result["profile"] for result in results if result.get("profile")]
+    if profiles:
+        stats = pstats.Stats(filename)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(filename)
+
+# Build the CIA with make_cia from the extracted partitions, the crc32 is
+# computed while extracting the rom when not given. The steps done by an
+# interrupted run are skipped, see Journal.
+def make_cia_build(fh, ciafilename, workdir, crc32, titleid, decrypted):
+    # the partitions extracted by an interrupted run
+    done = set()
+    for i in xrange(6):
+        step = journal.get("partition %d" % i) if journal is not None else None
+        if step is not None and os.path.isfile(os.path.join(workdir, step["file"])) and \
+                os.path.getsize(os.path.join(workdir, step["file"])) == step["size"]:
+            done.add(i)
+    extracted = journal.get("extract") if journal is not None else None
+    if extracted is not None and not all(i in done for i in xrange(6) if journal.get("partition %d" % i)):
+        extracted = None
+
+    def checkpoint(i, filename):
+        sync_file(filename)
+        journal.record("partition %d" % i, {"file": os.path.basename(filename), "size": os.path.getsize(filename)})
+
+    # Extract cxi and cfa
+    copied = crc32 is not None and rom_file_range(fh) is not None
+    with timed("extract" if copied or extracted is not None else "split") as record:
+        if extracted is not None:
+            crc32, hashes, methods = extracted["crc32"], {}, ["resumed"]
+        else:
+            crc32, hashes, methods = extract_rom(fh, workdir, crc32, done, checkpoint if journal is not None else None)
+            if journal is not None:
+                journal.record("extract", {"crc32": crc32})
+
+        contents = glob.glob(os.path.join(workdir, "*.[cC][xX][iI]"))
+        contents += glob.glob(os.path.join(workdir, "*.[cC][fF][aA]"))
+        if extracted is None:
+            record["written"] = sum(os.path.getsize(content) for content in contents) - \
+                sum(journal.get("partition %d" % i)["size"] for i in done)
+            record["read"] = record["written"] if copied else rom_size(fh)
+
+    if VERBOSE:
+        print "CRC32: %08X" % crc32
+        print "Extracted using: %s" % ", ".join(methods)
+        for i in sorted(hashes):
+            print "Partition %d SHA256: %s" % (i, binascii.hexlify(hashes[i]).upper())
+        print ""
+
+    with timed("lookup"):
+        xorpad_ref = None if decrypted else lookup_xorpad(titleid, crc32)
+
+    with timed("verify") as record, open(os.path.join(workdir, "0.cxi"), "rb") as cxi:
+        valid = verify_xorpad(cxi, xorpad_ref)
+        record["read"] = 0x400
+    if valid == False:
         for content in contents:
             os.remove(content)
-
-        if ret != 0:
-            print colorama.Fore.RED + "Error during CIA creation of '%s'" % filename
-            print colorama.Style.RESET_ALL + "Relaunch the program with -v for more informations."
-            print colorama.Fore.RED + "[ERROR]"
-        elif new_keyY:
-            print colorama.Fore.YELLOW + "[WARNING]"
-            print "This is a 9.6+ game which uses seed encryption and may not work directly!"
-            print
-            print "If this title is of the same region of your hardware you can decrypt it by visiting the eShop page of this title after the installation."
-            print "If this title is of a different region than your hardware you need to decrypt the CIA file using Decryp9WIP before the installation."
-            print colorama.Style.RESET_ALL
+        print_invalid_xorpad(decrypted)
+        return False
+
+    # Fix cxi, unless it was by an interrupted run (fixing it again would not change it anyway)
+    fixed = journal.get("fix") if journal is not None and 0 in done else None
+    with timed("fix") as record:
+        if fixed is not None:
+            save_data_size = fixed["save_data_size"]
         else:
-            print colorama.Fore.GREEN + "[OK]"
+            save_data_size = fix_cxi(glob.glob(os.path.join(workdir, "0.cxi"))[0], xorpad_ref)
+            record["read"] = record["written"] = 0x400
+            if journal is not None:
+                sync_file(os.path.join(workdir, "0.cxi"))
+                journal.record("fix", {"save_data_size": save_data_size})
+
+    # Generate make_cia command line, the CIA is written under a temporary name
+    partname = ciafilename + ".part"
+    cmdline = ["-v", "-o", partname, "--savesize=" + str(save_data_size)]
+
+    i = 0
+    for content in contents:
+        cmdline += ["--content" + str(i) + "=" + content, "--id_" + str(i) + "=" + str(i), "--index_" + str(i) + "=" + str(i)]
+        i += 1
+
+    # Generate CIA file, its output is collected so it can be printed with the rest of the job
+    with timed("make_cia") as record:
+        process = subprocess.Popen([make_cia] + cmdline, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        output = process.communicate()[0]
+        ret = process.returncode
+        record["read"] = sum(os.path.getsize(content) for content in contents)
+        if os.path.isfile(partname):
+            record["written"] = os.path.getsize(partname)
+    if VERBOSE:
+        sys.stdout.write(output)
+
+    if ret == 0:
+        publish_cia(partname, ciafilename)
+        if journal is not None:
+            journal.record("cia", {"size": os.path.getsize(ciafilename)})
+    elif os.path.isfile(partname):
+        os.remove(partname)
+    for content in contents:
+        os.remove(content)
+
+    if ret == 0 and output_sink is not None:
+        with timed("store") as record:
+            output_sink.add_file(os.path.basename(ciafilename), ciafilename)
+            record["read"] = record["written"] = os.path.getsize(ciafilename)
+        os.remove(ciafilename)
+    return ret
+
+# Build the CIA in process, streaming the contents from the rom
+def native_build(fh, ciafilename, workdir, crc32, titleid, decrypted):
+    if crc32 is None and journal is not None and journal.get("crc32") is not None:
+        crc32 = journal.get("crc32")["crc32"]
+    if crc32 is None and not decrypted:
+        with timed("crc") as record:
+            crc32 = file_crc32(fh)
+            record["read"] = rom_size(fh)
+        if journal is not None:
+            journal.record("crc32", {"crc32": crc32})
+    with timed("lookup"):
+        xorpad_ref = None if decrypted else lookup_xorpad(titleid, crc32)
+
+    # read ahead up to the end of the last partition built and write behind
+    rom = RomImage(fh)
+    end = max(offset + size for i, offset, size in rom.partitions if i < 6)
+    rom.close()
+    if output_sink is not None:
+        # the sink cannot seek back, the rom is read twice to know the CIA first
+        sources = []
+        def open_rom():
+            fh.seek(0)
+            sources.append(ReadAhead(fh, end, "build"))
+            return sources[-1]
+        with timed("build") as record:
+            records = stream_cia(open_rom, lambda size: output_sink.open(os.path.basename(ciafilename), size),
+                                 xorpad_ref, certchain)
+            record["read"] = sum(source.tell() for source in sources)
+            if records is not None:
+                record["written"] = output_sink.entries[-1]["size"]
+    else:
+        # the CIA is written under a temporary name, where an interrupted build
+        # goes on from the last content written (see Journal)
+        partname = ciafilename + ".part"
+        resumed = []
+        if journal is not None and os.path.isfile(partname):
+            while journal.get("content %d" % len(resumed)) is not None:
+                resumed.append(journal.get("content %d" % len(resumed)))
+            if resumed and os.path.getsize(partname) < resumed[-1]["end"]:
+                resumed = []
+
+        def checkpoint(n, step):
+            sink.flush()
+            os.fsync(out.fileno())
+            step["end"] = sink.tell()
+            journal.record("content %d" % n, step)
 
-        return ret
+        fh.seek(0)
+        with timed("build") as record, open(partname, "r+b" if resumed else "wb") as out:
+            source = ReadAhead(fh, end, "build")
+            sink = WriteBehind(out, "build")
+            try:
+                records = build_cia(source, sink, xorpad_ref, certchain, resumed, checkpoint if journal is not None else None)
+            finally:
+                source.close()
+                sink.close()
+            record["read"] = source.tell()
+            # the header is written last, at the start of the file
+            out.seek(0, os.SEEK_END)
+            record["written"] = out.tell()
+        if records is not None:
+            publish_cia(partname, ciafilename)
+            if journal is not None:
+                journal.record("cia", {"size": os.path.getsize(ciafilename)})
+    if records is None:
+        if output_sink is None:
+            os.remove(partname)
+        print_invalid_xorpad(decrypted)
+        return False
+
+    if VERBOSE:
+        for content_id, index, content_type, size, digest in records:
+            print "Content %d: %d bytes, SHA256: %s" % (index, size, binascii.hexlify(digest).upper())
+        print ""
+    return 0
+
+def cia_path(filename):
+    return os.path.join(CIA_DIR, os.path.splitext(os.path.basename(filename))[0]) + ".cia"
+
+# Convert a rom using workdir as scratch space. The CIA is built in process when
+# a certificate chain is available, with make_cia otherwise.
+def convert_to_cia(filename, workdir, crc32=None):
+    with open(filename, "rb") as fh:
+        return convert_source(fh, filename, workdir, crc32)
+
+# Convert the rom read from fh, a file or a zip member, named filename. The CIA
+# is written to ciafilename, in the cia directory by default.
+def convert_source(fh, filename, workdir, crc32=None, ciafilename=None):
+    rom = RomImage(fh)
+    titleid = rom.titleid
+    ncchFlag7 = rom.flag7()
+    rom.close()
+    decrypted = ncchFlag7 & 0x4
+    new_keyY = ncchFlag7 & 0x20
+
+    ciafilename = ciafilename or cia_path(filename)
+    if output_sink is not None:
+        # make_cia writes the CIA to workdir before it goes to the sink
+        ciafilename = os.path.join(workdir, os.path.basename(ciafilename))
+    # the CIA is renamed into place once built: a previous CIA, that may be hard
+    # linked from the output cache, is replaced and never rewritten in place
+
+    if certchain is not None:
+        ret = native_build(fh, ciafilename, workdir, crc32, titleid, decrypted)
+    else:
+        ret = make_cia_build(fh, ciafilename, workdir, crc32, titleid, decrypted)
+    if ret is False:
+        return False
+
+    if ret != 0:
+        print colorama.Fore.RED + "Error during CIA creation of '%s'" % filename
+        print colorama.Style.RESET_ALL + "Relaunch the program with -v for more informations."
+        print colorama.Fore.RED + "[ERROR]"
+    elif new_keyY:
+        print colorama.Fore.YELLOW + "[WARNING]"
+        print "This is a 9.6+ game which uses seed encryption and may not work directly!"
+        print
+        print "If this title is of the same region of your hardware you can decrypt it by visiting the eShop page of this title after the installation."
+        print "If this title is of a different region than your hardware you need to decrypt the CIA file using Decryp9WIP before the installation."
+        print colorama.Style.RESET_ALL
+    else:
+        print colorama.Fore.GREEN + "[OK]"
+
+    return ret
 
 def which(cmd):
     path = os.environ.get("PATH", os.defpath)
@@ -501,125 +2681,1319 @@ def get_tools_path():
     elif sys.platform == "linux" or sys.platform == "linux2":
         return os.path.join(bundle_dir, "tools", "linux" + BITS)
 
-def main_check(filename, remove):
-    with open(filename, 'rb') as fh:
-        titleid = get_titleid(fh)
-        # Decrypted
-        if get_ncchFlag7(fh) & 0x4:
-            print colorama.Fore.YELLOW + " [NOT NEEDED]"
-        elif not find_xorpad(titleid, crc32):
-            print colorama.Fore.RED + " [NOT FOUND]"
-            missing_xorpads.append([filename, crc32])
-            return
+# Globals the pool workers get from the main process
+WORKER_GLOBALS = ["tmpdir", "make_cia", "certchain", "VERBOSE", "xorpad_index", "PROFILE", "CHUNK_SIZE", "PIPELINE_DEPTH",
+                  "CACHE_DIR", "CIA_DIR", "XORPAD_DIR", "JOURNAL", "RESUME", "WORK_DIR"]
+
+# Set up the globals of a pool worker, workers leave Ctrl-C to the main process
+def init_worker(settings):
+    globals().update(settings)
+    # the archives opened by the main process share their file offsets with it
+    zip_archives.clear()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the pool stops its workers with SIGTERM. They leave the process group, so
+    # that stopping --watch or --serve with a signal to the whole group does not
+    # kill an idle worker holding the lock of the pool queue, which would hang the pool.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+# SIGTERM handler of --watch and --serve, they stop like on Ctrl-C
+def interrupt(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+# Pool kept by the conversion service between requests, see ConversionService
+worker_pool = None
+
+def new_pool(count):
+    return multiprocessing.Pool(count, init_worker, (dict((name, globals()[name]) for name in WORKER_GLOBALS),))
+
+# Convert a rom (or a .3ds inside a zip when entryname is set) in its own
+# scratch directory. When capture is set the output is returned instead of
+# printed, so that jobs running in parallel do not mix their output.
+# Returns (output, result), result holding the status and stage timings of the job.
+def convert_job(job):
+    global stage_stats, journal
+    rom, entryname, crc32, capture = job[:4]
+    # where convert_roms() placed the scratch space of the job
+    root = job[4] if len(job) > 4 else None
+
+    if capture:
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+    # the main process profiles the jobs it runs itself
+    profiler = None
+    if PROFILE and capture:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # jobs run by the main process must not mix their stages with the ones of the main loop
+    run_stages = stage_stats
+    stage_stats = collections.OrderedDict()
+    result = {"rom": rom, "entry": entryname, "crc32": crc32}
+    start = time.time()
+    # the scratch space of a journaled conversion is kept until it is done
+    journal = None
+    if JOURNAL and output_sink is None:
+        journal = Journal(rom, entryname, RESUME)
+        recorded = journal.get("workdir")
+        if root is not None and root == RAM_WORK_DIR and not (recorded is not None and os.path.isdir(recorded["path"])):
+            # extracted to RAM, the conversion is done over if interrupted
+            journal.discard()
+            journal = None
+    if journal is not None:
+        workdir = journal_workdir(rom, entryname, root)
+        # where an interrupted run extracted the rom, WORK_DIR may have changed since
+        if journal.get("workdir") is not None and os.path.isdir(journal.get("workdir")["path"]):
+            workdir = journal.get("workdir")["path"]
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        if journal.get("workdir") != {"path": os.path.abspath(workdir)}:
+            journal.record("workdir", {"path": os.path.abspath(workdir)})
+    else:
+        workdir = tempfile.mkdtemp(dir=root or tmpdir)
+    finished = False
+    try:
+        name = rom if entryname is None else "\t-> " + entryname
+        if VERBOSE:
+            print name
+            print ""
+        else:
+            sys.stdout.write(name + " ")
+            sys.stdout.flush()
+
+        built = journal.get("cia") if journal is not None else None
+        if built is not None and file_signature(cia_path(entryname or rom)) is not None and \
+                file_signature(cia_path(entryname or rom))[0] == built["size"]:
+            # built by an interrupted run
+            print colorama.Fore.GREEN + "[OK] (resumed)"
+            ret = 0
+        elif entryname is None:
+            # the crc32 is computed while extracting the rom when not cached
+            ret = convert_to_cia(rom, workdir, crc32)
+        else:
+            # read straight from the archive, the rom is never written whole to workdir
+            with contextlib.closing(ZipRomReader(rom, entryname)) as fh:
+                ret = convert_source(fh, entryname, workdir, crc32)
+        finished = True
+        # the journal of a CIA built is kept until it is in the output cache, see convert_rows()
+        if journal is not None and ret != 0:
+            journal.clear()
+
+        result["status"] = "invalid" if ret is False else "ok" if ret == 0 else "error"
+        if ret == 0 and output_sink is not None:
+            # hashed on its way to the sink
+            entry = output_sink.entries[-1]
+            result["cia"], result["sha256"] = entry["cia"], entry["sha256"]
+            result["archive"] = output_sink.target
+        elif ret == 0:
+            # not read again to be hashed, its contents are hashed in its TMD
+            result["cia"] = cia_path(entryname or rom)
+        result["seconds"] = round(time.time() - start, 6)
+        result["stages"] = stage_stats
+
+        if VERBOSE:
+            for stage, entry in finish_stages(stage_stats).items():
+                print "%-8s %8.3f s %12d bytes read %12d bytes written" % (stage, entry["seconds"], entry["bytes_read"], entry["bytes_written"])
+            print ""
+        sys.stdout.write(colorama.Style.RESET_ALL)
+        sys.stdout.flush()
+        if profiler is not None:
+            profiler.disable()
+            handle, result["profile"] = tempfile.mkstemp(".prof", dir=tmpdir)
+            os.close(handle)
+            profiler.dump_stats(result["profile"])
+        return (sys.stdout.getvalue() if capture else None), result
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if capture:
+            sys.stdout = stdout
+        stage_stats = run_stages
+        if finished or journal is None:
+            shutil.rmtree(workdir, True)
+        journal = None
+
+# Bytes of scratch space and of room in CIA_DIR the conversion of a rom needs,
+# from the sizes of its partitions: make_cia needs them extracted, the CIA holds
+# them all. What an interrupted conversion wrote to CIA_DIR is deducted.
+def job_space(rom, entryname):
+    try:
+        if entryname is None:
+            fh = open(rom, "rb")
+        else:
+            fh = ZipRomReader(rom, entryname)
+        with contextlib.closing(fh):
+            image = RomImage(fh)
+            contents = sum(size for i, offset, size in image.partitions if i < 6)
+            image.close()
+    except (IOError, EnvironmentError, zipfile.BadZipfile, KeyError):
+        # the job reports it
+        return 0, 0
+    # header, certificate chain, ticket, TMD and meta
+    cia = contents + 0x10000
+    scratch = 0 if certchain is not None else contents
+    if output_sink is not None:
+        # make_cia writes the CIA to the scratch space, nothing goes to CIA_DIR
+        return (scratch + cia if scratch else 0), 0
+    partname = cia_path(entryname or rom) + ".part"
+    if JOURNAL and RESUME and os.path.isfile(partname):
+        cia -= os.path.getsize(partname)
+    return scratch, max(cia, 0)
+
+# Admission control of the jobs on the free space of the filesystems they write
+# to: a job starts once its scratch space and the room for its CIA are reserved,
+# and the reservations are released as the jobs finish. Small scratch spaces go
+# to RAM_WORK_DIR, the others to the disk scratch directory.
+class ScratchSpace(object):
+    def __init__(self, disk_root):
+        self.disk_root = disk_root
+        # filesystem -> bytes reserved by the jobs running
+        self.reserved = collections.defaultdict(int)
+
+    # filesystem of directory and the bytes free on it for another job
+    def free(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if hasattr(os, "statvfs"):
+            st = os.statvfs(directory)
+            key, free = os.stat(directory).st_dev, st.f_bavail * st.f_frsize
         else:
-            print colorama.Fore.GREEN + " [FOUND]"
-    if remove:
+            available = c_ulonglong(0)
+            windll.kernel32.GetDiskFreeSpaceExW(unicode(os.path.abspath(directory)), None, None, byref(available))
+            key, free = os.path.splitdrive(os.path.abspath(directory))[0].lower(), available.value
+        return key, free - self.reserved[key] - SCRATCH_MARGIN
+
+    # Reserve the space of a job, returns (scratch root of the job, reservation)
+    # or None when there is not enough free space
+    def reserve(self, rom, entryname, scratch, cia):
+        roots = [self.disk_root]
+        if RAM_WORK_DIR is not None and 0 < scratch <= RAM_SCRATCH_MAX:
+            roots.insert(0, RAM_WORK_DIR)
+        if JOURNAL and RESUME and output_sink is None:
+            # an interrupted conversion goes on where its scratch space is
+            for root in roots:
+                workdir = journal_workdir(rom, entryname, root)
+                if os.path.isdir(workdir):
+                    roots = [root]
+                    scratch -= sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir))
+                    break
+        for root in roots:
+            claims = collections.defaultdict(int)
+            frees = {}
+            for directory, size in ((root, scratch), (CIA_DIR, cia)):
+                if size > 0:
+                    key, frees[key] = self.free(directory)
+                    claims[key] += size
+            if all(claims[key] <= frees[key] for key in claims):
+                for key in claims:
+                    self.reserved[key] += claims[key]
+                return root, claims
+        return None
+
+    def release(self, claims):
+        for key in claims:
+            self.reserved[key] -= claims[key]
+
+# Result of a job not run for lack of free space, like convert_job() returns it
+def no_space_job(job, scratch, cia):
+    rom, entryname, crc32 = job[:3]
+    output = (rom if entryname is None else "\t-> " + entryname) + " " + colorama.Fore.RED + \
+        "[ERROR] Not enough free space: %.1f MB of scratch space and %.1f MB in %s needed" % (
+            scratch / (1024.0 * 1024), cia / (1024.0 * 1024), CIA_DIR) + colorama.Style.RESET_ALL + "\n"
+    result = {"rom": rom, "entry": entryname, "crc32": crc32, "status": "error",
+              "seconds": 0.0, "stages": collections.OrderedDict()}
+    return output, result
+
+# Convert a list of (rom, entryname, crc32) jobs, running up to count of them
+# in parallel (on the worker pool when there is one). A job only starts once
+# the space it needs is reserved, see ScratchSpace. The output of the jobs is
+# printed in order. Returns the results of the jobs, see convert_job().
+def convert_roms(jobs, count):
+    pool = worker_pool
+    if pool is None and count > 1 and len(jobs) > 1:
+        pool = new_pool(min(count, len(jobs)))
+    space = ScratchSpace(WORK_DIR if JOURNAL and output_sink is None else tmpdir)
+    queue = collections.deque(jobs)
+    # jobs started, in order: (job, function returning its result, reservation)
+    started = collections.deque()
+
+    # start the next job, unless it must wait for the space of the jobs running
+    def start():
+        job = queue[0]
+        scratch, cia = job_space(job[0], job[1])
+        reservation = space.reserve(job[0], job[1], scratch, cia)
+        if reservation is None and started:
+            return False
+        queue.popleft()
+        if reservation is None:
+            output = no_space_job(job, scratch, cia)
+            started.append((job, lambda: output, {}))
+        elif pool is not None:
+            # a timeout keeps the wait interruptible by Ctrl-C
+            pending = pool.apply_async(convert_job, (job + (True, reservation[0]),))
+            started.append((job, lambda: pending.get(0xFFFF), reservation[1]))
+        else:
+            args = job + (False, reservation[0])
+            started.append((job, lambda: convert_job(args), reservation[1]))
+        return True
+
+    done = []
+    try:
+        previous = None
+        while queue or started:
+            while queue and len(started) < (count if pool is not None else 1) and start():
+                pass
+            (rom, entryname, crc32), run, claims = started.popleft()
+            if rom != previous:
+                if previous is not None:
+                    print ""
+                if entryname is not None:
+                    print rom
+                previous = rom
+            try:
+                output, result = run()
+            finally:
+                # the scratch space is gone, the CIA is now counted as used
+                space.release(claims)
+            if output:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+            done.append(result)
+        print ""
+        if pool is not None and pool is not worker_pool:
+            pool.close()
+    finally:
+        if pool is not None and pool is not worker_pool:
+            pool.terminate()
+            pool.join()
+    return done
+
+# Verify CIAs with verify_cia(), up to count of them in parallel (on the worker
+# pool when there is one). Their status is printed in order. Returns their results.
+def verify_cias(filenames, count):
+    pool = worker_pool
+    if pool is None and count > 1 and len(filenames) > 1:
+        pool = new_pool(min(count, len(filenames)))
+    if pool is not None:
+        results = pool.imap(verify_cia, filenames)
+        next_result = lambda: results.next(0xFFFF)
+    else:
+        results = (verify_cia(filename) for filename in filenames)
+        next_result = results.next
+
+    done = []
+    try:
+        for filename in filenames:
+            result = next_result()
+            sys.stdout.write(filename + " ")
+            if result["status"] != "ok":
+                print colorama.Fore.RED + "[INVALID] " + "; ".join(result["errors"])
+            elif result["exheader"] == "no xorpad":
+                print colorama.Fore.YELLOW + "[OK] exheader not checked, its xorpad is missing"
+            else:
+                print colorama.Fore.GREEN + "[OK]"
+            if VERBOSE:
+                for content in result["contents"]:
+                    print "\t%d %08x %12d bytes %s" % (content["index"], content["id"], content["size"], content["status"])
+            sys.stdout.write(colorama.Style.RESET_ALL)
+            done.append(result)
+        if pool is not None and pool is not worker_pool:
+            pool.close()
+    finally:
+        if pool is not None and pool is not worker_pool:
+            pool.terminate()
+            pool.join()
+    return done
+
+# Identifies what builds the CIAs in the output cache: the builder and the
+# certificate chain or make_cia it uses
+def converter_id():
+    if certchain is not None:
+        return "%d/native/%s" % (OUTPUT_VERSION, hashlib.sha256(certchain).hexdigest()[:16])
+    st = os.stat(make_cia)
+    return "%d/make_cia/%d/%d" % (OUTPUT_VERSION, st.st_size, st.st_mtime)
+
+# Key of the CIA of a manifest row in the output cache, None when it cannot be known
+def output_key(row, converter):
+    if row.get("rom_size") is None:
+        return None
+    if row["flag7"] & 0x4:
+        xorpad = "none"
+    else:
+        found = lookup_xorpad(row["titleid"], row["crc32"])
+        if found is None:
+            return None
+        xorpad = binascii.hexlify(sha256(read_xorpad(found, 0x400)))
+    return (row["crc32"], row["rom_size"], xorpad, converter)
+
+# Path of the cached CIA for key, None when there is none or it changed since
+def cached_output(db, key):
+    found = db.execute("SELECT cia, cia_size, cia_mtime FROM outputs WHERE crc32 = ? AND size = ? AND xorpad = ? AND converter = ?",
+                       key).fetchone()
+    if found is None:
+        return None
+    if file_signature(found[0]) != (found[1], found[2]):
+        db.execute("DELETE FROM outputs WHERE crc32 = ? AND size = ? AND xorpad = ? AND converter = ?", key)
+        return None
+    return found[0]
+
+# The CIA is known by its size and mtime. The columns are named, the outputs
+# table of older caches has an unused sha256 column.
+def store_output(db, key, ciafilename):
+    size, mtime = file_signature(ciafilename)
+    db.execute("INSERT OR REPLACE INTO outputs (crc32, size, xorpad, converter, cia, cia_size, cia_mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+               key + (ciafilename, size, mtime))
+
+def same_file(a, b):
+    if os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b)):
+        return True
+    try:
+        sa, sb = os.stat(a), os.stat(b)
+    except OSError:
+        return False
+    return sa.st_ino != 0 and (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino)
+
+# Hard link source to target, copying it when hard links are not available
+def link_cia(source, target):
+    temporary = target + ".tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    try:
+        os.link(source, temporary)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, temporary)
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(temporary, target)
+
+# Take the CIA of a row from the output cache, returns its status or None when it is not there
+def reuse_output(db, row, key):
+    if key is None:
+        return None
+    cached = cached_output(db, key)
+    if cached is None:
+        return None
+    target = cia_path(row["entry"] or row["source"])
+    if same_file(cached, target):
+        status = "cached"
+    else:
+        link_cia(cached, target)
+        status = "linked"
+    sys.stdout.write(row["source"] + " " if row["entry"] is None else row["source"] + " -> " + row["entry"] + " ")
+    print colorama.Fore.GREEN + ("[UP TO DATE]" if status == "cached" else "[LINKED] " + cached)
+    sys.stdout.write(colorama.Style.RESET_ALL)
+    return {"rom": row["source"], "entry": row["entry"], "crc32": row["crc32"], "status": status, "seconds": 0.0,
+            "stages": collections.OrderedDict()}
+
+# Convert manifest rows, adding their results to results. Rows whose rom, xorpad and
+# converter match a CIA already built are not converted again: the CIA is kept, or
+# hard linked when it has another name (the same rom in several zips).
+def convert_rows(rows, results, jobs):
+    if not rows:
+        return
+    print colorama.Style.BRIGHT + "Creating CIA..."
+    print colorama.Style.RESET_ALL
+
+    with timed("convert"):
+        db = open_cache()
+        try:
+            converter = converter_id()
+            reused = len(results)
+            keys = {}
+            queued = set()
+            queue = []
+            duplicates = []
+            # the CIAs go to the sink of the main process: no output cache and no parallel jobs
+            if output_sink is not None:
+                jobs = 1
+            for row in rows:
+                key = output_key(row, converter) if output_sink is None else None
+                keys[(row["source"], row["entry"])] = key
+                result = None if FORCE else reuse_output(db, row, key)
+                if result is not None:
+                    results.append(result)
+                elif key is not None and key in queued:
+                    duplicates.append(row)
+                else:
+                    queued.add(key)
+                    queue.append(row)
+            db.commit()
+            if len(results) > reused:
+                print ""
+
+            while queue:
+                done = convert_roms([(row["source"], row["entry"], row["crc32"]) for row in queue], jobs)
+                with db:
+                    for result in done:
+                        key = keys[(result["rom"], result["entry"])]
+                        if key is not None and result["status"] == "ok":
+                            store_output(db, key, result["cia"])
+                        # the conversion is over, see Journal
+                        db.execute("DELETE FROM journal WHERE path = ? AND member = ?",
+                                   (os.path.realpath(result["rom"]), result["entry"] or ""))
+                results += done
+
+                # the duplicates of the roms that failed are converted on their own
+                queue = []
+                for row in duplicates:
+                    result = reuse_output(db, row, keys[(row["source"], row["entry"])])
+                    if result is not None:
+                        results.append(result)
+                    else:
+                        queue.append(row)
+                if duplicates and not queue:
+                    print ""
+                duplicates = []
+                db.commit()
+        finally:
+            db.close()
+
+# Check if the xorpad of a manifest row is available and print the result
+def check_row(row):
+    if row["flag7"] & 0x4:
+        row["xorpad"] = "not needed"
+        print colorama.Fore.YELLOW + " [NOT NEEDED]"
+    elif lookup_xorpad(row["titleid"], row["crc32"]) is None:
+        row["xorpad"] = "missing"
+        print colorama.Fore.RED + " [NOT FOUND]"
+    else:
+        row["xorpad"] = "found"
+        print colorama.Fore.GREEN + " [FOUND]"
+    sys.stdout.write(colorama.Style.RESET_ALL)
+    sys.stdout.flush()
+
+# Read the title id, product code, crypto flags and partitions of a rom into a manifest row
+def read_rom_info(fh, row):
+    rom = RomImage(fh)
+    row["titleid"] = rom.titleid
+    row["flag7"] = rom.flag7()
+    row["product_code"] = rom.product_code()
+    row["partitions"] = [(i, offset, size) for i, offset, size in rom.partitions if i < 6]
+    rom.close()
+
+# Save the manifest rows in the rom catalog. The rows of the roms scanned (the
+# sources of the rows and the paths in scanned) are replaced, so that the members
+# gone from a zip go with them, and the rows of the roms deleted or renamed since
+# they were scanned are removed.
+def update_catalog(manifest, scanned=()):
+    db = open_cache()
+    try:
+        with db:
+            sources = set(scanned) | set(row["source"] for row in manifest)
+            db.executemany("DELETE FROM catalog WHERE path = ?", [(source,) for source in sources])
+            db.executemany("INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(row["source"], row["entry"] or "", row["size"], row["mtime"], row["titleid"],
+                             row.get("product_code", ""), row["crc32"], json.dumps(row.get("partitions", [])),
+                             0 if row["flag7"] & 0x4 else 1, 1 if row["flag7"] & 0x20 else 0)
+                            for row in manifest])
+            gone = [(path,) for (path,) in db.execute("SELECT DISTINCT path FROM catalog").fetchall() if not os.path.exists(path)]
+            db.executemany("DELETE FROM catalog WHERE path = ?", gone)
+    finally:
+        db.close()
+
+# Print the catalog rows whose path, title id or product code contain text
+def list_catalog(text=""):
+    db = open_cache()
+    try:
+        pattern = "%" + text + "%"
+        rows = db.execute("SELECT path, member, titleid, product_code, crc32, partitions, encrypted, seed FROM catalog "
+                          "WHERE path LIKE ? OR member LIKE ? OR titleid LIKE ? OR product_code LIKE ? "
+                          "ORDER BY path, member", (pattern,) * 4).fetchall()
+    finally:
+        db.close()
+
+    for path, member, titleid, product_code, crc32, partitions, encrypted, seed in rows:
+        size = sum(partition[2] for partition in json.loads(partitions))
+        flags = ("encrypted" if encrypted else "decrypted") + (", seed" if seed else "")
+        print "%s  %-16s %08X %6d MB  %s  (%s)" % (titleid, product_code, crc32, size / (1024 * 1024),
+                                                  path + (" -> " + member if member else ""), flags)
+    print "%d roms" % len(rows)
+
+# Scan the roms once and check their xorpads. Returns the manifest: one row per
+# .3ds (plain or inside a zip) with its crc32, title id, crypto flags and
+# xorpad status. Rows of a previous manifest are reused for unchanged roms.
+def scan_roms(roms, previous=[]):
+    reusable = {}
+    for row in previous:
+        reusable.setdefault(row["source"], []).append(row)
+
+    manifest = []
+    for rom in roms:
+        st = os.stat(rom)
+        rows = reusable.get(rom, [])
+        if rows and any(row["size"] != st.st_size or row["mtime"] != st.st_mtime for row in rows):
+            rows = []
+
+        if rows:
+            if rows[0]["entry"] is not None:
+                print rom
+            for row in rows:
+                sys.stdout.write(rom + " " if row["entry"] is None else "\t-> " + row["entry"] + " ")
+                check_row(row)
+                manifest.append(row)
+        elif zipfile.is_zipfile(rom):
+            print rom
+            with zipfile.ZipFile(rom, "r") as e:
+                for entry in e.infolist():
+                    basename = os.path.basename(entry.filename)
+                    if not basename or not basename.lower().endswith(".3ds"):
+                        continue
+                    sys.stdout.write("\t-> " + entry.filename + " ")
+                    sys.stdout.flush()
+                    row = {"source": rom, "entry": entry.filename, "size": st.st_size, "mtime": st.st_mtime,
+                           "crc32": entry.CRC & 0xFFFFFFFF, "rom_size": entry.file_size}
+                    store_crc32(rom, row["crc32"], entry.filename, entry.file_size)
+                    # the headers are all that is needed to check the rom
+                    header = e.open(entry, "r").read(0x10000)
+                    read_rom_info(io.BytesIO(header), row)
+                    check_row(row)
+                    manifest.append(row)
+        else:
+            sys.stdout.write(rom + " ")
+            sys.stdout.flush()
+            row = {"source": rom, "entry": None, "size": st.st_size, "mtime": st.st_mtime,
+                   "crc32": rom_crc32(rom), "rom_size": st.st_size}
+            with open(rom, "rb") as fh:
+                read_rom_info(fh, row)
+            check_row(row)
+            manifest.append(row)
+
+        print ""
+
+    return manifest
+
+# Check again the rows still missing their xorpad
+def recheck_manifest(manifest):
+    for row in manifest:
+        if row["xorpad"] == "missing":
+            sys.stdout.write(row["source"] + " " if row["entry"] is None else row["source"] + " -> " + row["entry"] + " ")
+            check_row(row)
+    print ""
+
+def load_manifest(filename):
+    if filename is None or not os.path.isfile(filename):
+        return []
+    with open(filename, "r") as fh:
+        return json.load(fh)
+
+def save_manifest(filename, manifest):
+    if filename is None:
+        return
+    with open(filename + ".tmp", "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    if os.path.exists(filename):
         os.remove(filename)
+    os.rename(filename + ".tmp", filename)
+
+# Write the headers of the roms missing their xorpad to ncchinfo.bin (options of
+# ncchinfo_gen(), NCCHINFO_OPTIONS by default), once per title id and crc32. Zipped
+# roms get their first 0x10000 bytes extracted in tmpdir for that. Returns the files written.
+def generate_ncchinfo(manifest, options=None):
+    files = []
+    seen = set()
+    for i, row in enumerate(manifest):
+        if row["xorpad"] != "missing" or (row["titleid"], row["crc32"]) in seen:
+            continue
+        seen.add((row["titleid"], row["crc32"]))
+        filename = row["source"]
+        if row["entry"] is not None:
+            filename = os.path.join(tmpdir, "%d-%s" % (i, os.path.basename(row["entry"])))
+            with zipfile.ZipFile(row["source"], "r") as e, open(filename, "wb") as target:
+                target.write(e.open(row["entry"], "r").read(0x10000))
+        files.append([filename, row["crc32"]])
+    return ncchinfo_gen(files, **(NCCHINFO_OPTIONS if options is None else options))
+
+# Reports the files changed in some directories, with inotify on Linux and by
+# polling the directory listings otherwise
+class DirectoryWatcher(object):
+    def __init__(self, directories):
+        self.directories = directories
+        self.fd = None
+        self.wds = {}
+        self.listings = {}
+
+        if libc is not None and hasattr(libc, "inotify_init1"):
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                for directory in directories:
+                    wd = libc.inotify_add_watch(fd, directory, mask)
+                    if wd < 0:
+                        break
+                    self.wds[wd] = directory
+                else:
+                    self.fd = fd
+                if self.fd is None:
+                    os.close(fd)
+
+        if self.fd is None:
+            for directory in directories:
+                self.listings[directory] = self._list(directory)
+
+    @property
+    def method(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _list(self, directory):
+        listing = {}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            listing[path] = (st.st_size, st.st_mtime)
+        return listing
+
+    # Wait up to timeout seconds for changes. Returns {path: complete}, complete
+    # telling the last event of the file was its closing after a write or its
+    # moving in the directory. Polling never knows it.
+    def wait(self, timeout):
+        changed = {}
+        if self.fd is None:
+            time.sleep(min(timeout, WATCH_INTERVAL))
+            for directory in self.directories:
+                listing = self._list(directory)
+                previous = self.listings[directory]
+                for path in set(listing) | set(previous):
+                    if listing.get(path) != previous.get(path):
+                        changed[path] = False
+                self.listings[directory] = listing
+            return changed
+
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return changed
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return changed
+            raise
+
+        while True:
+            try:
+                buf = os.read(self.fd, 0x10000)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                name = buf[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\x00")
+                offset += INOTIFY_EVENT.size + length
+                if wd in self.wds and name:
+                    changed[os.path.join(self.wds[wd], name)] = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+        return changed
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+# A converted rom is skipped at startup when its CIA is newer than the rom
+def cia_is_current(row):
+    ciafilename = cia_path(row["entry"] or row["source"])
+    return os.path.isfile(ciafilename) and os.path.getmtime(ciafilename) >= row["mtime"]
+
+# Write ncchinfo.bin for the roms still waiting for their xorpad
+def report_blocked(manifest):
+    blocked = [row for row in manifest if row["xorpad"] == "missing"]
+    if blocked:
+        with timed("ncchinfo"):
+            generate_ncchinfo(manifest)
+        print ""
+        print "%d roms are waiting for their xorpads, they will be converted once these are in the 'xorpads' directory" % len(blocked)
+        print ""
+
+# --watch: convert the roms of the manifest that are not converted yet, then
+# watch roms/ and xorpads/ and convert the roms landing there, or the ones
+# waiting for the xorpads landing there, once their files are complete.
+# Only the changed files are scanned. Runs until Ctrl-C or SIGTERM.
+def watch_roms(manifest, results, jobs, manifest_file):
+    signal.signal(signal.SIGTERM, interrupt)
+
+    watcher = DirectoryWatcher(["roms", XORPAD_DIR])
+    try:
+        report_blocked(manifest)
+        convert_rows([row for row in manifest if row["xorpad"] != "missing" and not cia_is_current(row)], results, jobs)
+        print colorama.Style.BRIGHT + "Watching 'roms' and 'xorpads' (%s), press Ctrl-C to stop..." % watcher.method
+        print colorama.Style.RESET_ALL
+
+        # path -> (signature, time of the last change, complete)
+        pending = {}
+        while True:
+            now = time.time()
+            for path, complete in watcher.wait(WATCH_SETTLE / 4 if pending else WATCH_INTERVAL).items():
+                pending[path] = (file_signature(path), now, complete)
+
+            now = time.time()
+            roms = []
+            xorpads = False
+            for path, (signature, since, complete) in pending.items():
+                current = file_signature(path)
+                if current != signature:
+                    pending[path] = (current, now, False)
+                    continue
+                if current is not None and not complete and now - since < WATCH_SETTLE:
+                    continue
+                del pending[path]
+                if os.path.dirname(path) == XORPAD_DIR:
+                    xorpads = True
+                elif fnmatch.fnmatch(os.path.basename(path), ROM_PATTERN):
+                    roms.append(path)
+            if not roms and not xorpads:
+                continue
+
+            queue = []
+            if roms:
+                print colorama.Style.BRIGHT + "Checking for xorpads..."
+                print colorama.Style.RESET_ALL
+                with timed("scan"):
+                    previous = [row for row in manifest if row["source"] in roms]
+                    manifest[:] = [row for row in manifest if row["source"] not in roms]
+                    rows = scan_roms([rom for rom in sorted(roms) if os.path.isfile(rom)], previous)
+                manifest += rows
+                queue += [row for row in rows if row["xorpad"] != "missing"]
+                update_catalog(rows, roms)
+            if xorpads:
+                blocked = [row for row in manifest if row["xorpad"] == "missing"]
+                if blocked:
+                    print colorama.Style.BRIGHT + "Checking for xorpads..."
+                    print colorama.Style.RESET_ALL
+                    with timed("scan"):
+                        load_xorpad_index()
+                        recheck_manifest(manifest)
+                    queue += [row for row in blocked if row["xorpad"] != "missing"]
+                else:
+                    load_xorpad_index()
+
+            save_manifest(manifest_file, manifest)
+            convert_rows(queue, results, jobs)
+            if roms or queue:
+                report_blocked(manifest)
+    except KeyboardInterrupt:
+        print colorama.Style.RESET_ALL + "Stopped watching."
+    finally:
+        watcher.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+# Library use: load this file as a module (see benchmark.py), call setup() with
+# the directories to use, then the functions below. They take explicit paths,
+# print nothing and return their results as dicts and lists.
+
+# Set the directories and the tools used. Paths are made absolute, so the working
+# directory can change afterwards. make_cia and the certificate chain are looked
+# for like the command line does when not given. Raises IOError when neither is found.
+def setup(cia_dir="cia", xorpad_dir="xorpads", cache_dir="cache", work_dir=None, make_cia_path=None, certchain_path=None,
+          verbose=False):
+    global CIA_DIR, XORPAD_DIR, CACHE_DIR, VERBOSE, tmpdir, make_cia, certchain, xorpad_index
+    CIA_DIR = os.path.abspath(cia_dir)
+    XORPAD_DIR = os.path.abspath(xorpad_dir)
+    CACHE_DIR = os.path.abspath(cache_dir)
+    VERBOSE = verbose
+
+    if certchain_path is not None:
+        with open(certchain_path, "rb") as fh:
+            certchain = fh.read()
+    else:
+        certchain = load_certchain()
+    make_cia = make_cia_path or which("make_cia")
+    if make_cia is None and certchain is None:
+        raise IOError("make_cia not found and no " + CERTCHAIN_FILE)
+
+    for directory in [CIA_DIR, XORPAD_DIR]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    shutdown()
+    tmpdir = tempfile.mkdtemp(dir=work_dir)
+    xorpad_index = None
+    load_xorpad_index()
+
+# Remove the scratch directory of setup() and close the archives kept open
+def shutdown():
+    global tmpdir
+    close_archives()
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir, True)
+        tmpdir = None
+    if RAM_WORK_DIR is not None and os.path.isdir(RAM_WORK_DIR) and not os.listdir(RAM_WORK_DIR):
+        os.rmdir(RAM_WORK_DIR)
+
+# Call func, returns (what it printed, what it returned)
+def captured(func, *args):
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        ret = func(*args)
+        return sys.stdout.getvalue(), ret
+    finally:
+        sys.stdout = stdout
+
+# Scan roms (.3ds files or zips of them) and look for their xorpads, the xorpads
+# added since the last call included. Returns their manifest rows, see scan_roms()
+def scan(paths):
+    load_xorpad_index()
+    paths = [os.path.abspath(path) for path in paths]
+    rows = captured(scan_roms, paths)[1]
+    update_catalog(rows, paths)
+    return rows
+
+# Look for the exheader xorpad of the rom read from fh and check that it decrypts
+# the exheader. The crc32 is computed when not given and needed.
+def check_xorpad(fh, crc32=None):
+    rom = RomImage(fh)
+    titleid = rom.titleid
+    encrypted = not rom.flag7() & 0x4
+    rom.close()
+    result = {"titleid": titleid, "crc32": crc32, "encrypted": encrypted, "xorpad": None, "valid": None}
+    if encrypted:
+        if crc32 is None:
+            result["crc32"] = crc32 = file_crc32(fh)
+        result["xorpad"] = lookup_xorpad(titleid, crc32)
+        if result["xorpad"] is not None:
+            result["valid"] = verify_xorpad(fh, result["xorpad"])
+    return result
+
+# Convert a rom (or the .3ds entry of a zip) to a CIA in the cia directory, in this
+# process. Returns the result of convert_job(), with the output of the conversion.
+def convert(path, entry=None, crc32=None):
+    output, result = convert_job((os.path.abspath(path), entry, crc32, True))
+    result["output"] = output
+    return result
+
+# Convert the rom read from fh, a seekable file-like, to the CIA output
+def convert_stream(fh, output, crc32=None):
+    output = os.path.abspath(output)
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        text, ret = captured(convert_source, fh, output, workdir, crc32, output)
+    finally:
+        shutil.rmtree(workdir, True)
+    return {"cia": output if ret == 0 else None, "status": "invalid" if ret is False else "ok" if ret == 0 else "error",
+            "output": text}
+
+# Convert manifest rows like the command line does, up to jobs at a time: the CIAs
+# up to date are kept and the rows still missing their xorpad skipped. Returns the
+# results, see convert_job() and reuse_output().
+def convert_all(rows, jobs=1):
+    results = []
+    captured(convert_rows, [row for row in rows if row["xorpad"] != "missing"], results, jobs)
+    return results
+
+# Write the ncchinfo entries of the manifest rows missing their xorpad, see
+# ncchinfo_gen() for the options. Returns the files written.
+def write_ncchinfo(rows, output, **options):
+    return captured(generate_ncchinfo, rows, dict(options, output=os.path.abspath(output)))[1]
+
+# Verify CIAs, up to jobs at a time, see verify_cia()
+def verify(paths, jobs=1):
+    return captured(verify_cias, [os.path.abspath(path) for path in paths], jobs)[1]
+
+# Local conversion service: a HTTP server answering JSON requests with the library
+# functions. The xorpad index, the zip archives and the worker pool are kept from
+# one request to the next. Requests are handled one at a time, each one spreading
+# its roms over the pool. Every request must carry the token of the service, see
+# serve(), and the POST ones be sent as application/json, which a web page cannot
+# do without a preflight request the service does not answer. Only files under
+# the directory of 3ds-to-cia are written.
+#   GET  /status                                         settings and counters
+#   POST /scan      {"roms": [paths]}                    manifest rows, see scan()
+#   POST /convert   {"roms": [paths], "force": false}    scan and convert_all() results
+#   POST /verify    {"cias": [paths]}                    see verify()
+#   POST /ncchinfo  {"roms": [paths], "output": path}    files written, see write_ncchinfo()
+class ConversionService(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, jobs, token):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.jobs = jobs
+        self.token = token
+        self.index = None
+        self.served = 0
+
+    # The workers get the xorpad index when they start, the pool is started
+    # again when xorpads were added or removed
+    def refresh(self):
+        global worker_pool
+        index = load_xorpad_index()
+        if index != self.index:
+            self.stop_pool()
+            self.index = index
+        if worker_pool is None and self.jobs > 1:
+            worker_pool = new_pool(self.jobs)
+
+    def stop_pool(self):
+        global worker_pool
+        if worker_pool is not None:
+            worker_pool.terminate()
+            worker_pool.join()
+            worker_pool = None
+
+    def status(self):
+        return {"builder": "native" if certchain is not None else "make_cia", "jobs": self.jobs, "cia_dir": CIA_DIR,
+                "xorpad_dir": XORPAD_DIR, "xorpads": len(self.index or {}), "archives": len(zip_archives),
+                "pool": worker_pool is not None, "served": self.served}
+
+    def answer(self, path, request):
+        global FORCE
+        self.refresh()
+        if path == "/scan":
+            return scan(request["roms"])
+        elif path == "/convert":
+            rows = scan(request["roms"])
+            FORCE = bool(request.get("force"))
+            try:
+                return {"roms": rows, "results": convert_all(rows, self.jobs)}
+            finally:
+                FORCE = False
+        elif path == "/verify":
+            return verify(request["cias"], self.jobs)
+        elif path == "/ncchinfo":
+            options = dict((key, request[key]) for key in ["sections", "max_entries", "max_mb"] if key in request)
+            output = os.path.realpath(request.get("output", "ncchinfo.bin"))
+            if not output.startswith(os.path.join(os.path.realpath(os.getcwd()), "")):
+                raise ValueError("the output must be under " + os.getcwd())
+            return write_ncchinfo(scan(request["roms"]), output, **options)
+        return None
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # answers 401 to the requests without the token of the service
+    def authorized(self):
+        if hmac.compare_digest(self.headers.getheader("authorization", ""), "Bearer " + self.server.token):
+            return True
+        self.send_json(401, {"error": "missing or wrong token"})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == "/status":
+            self.send_json(200, self.server.status())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.headers.gettype() != "application/json":
+            self.send_json(415, {"error": "requests must be sent as application/json"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("content-length", 0))) or "{}")
+        except ValueError:
+            self.send_json(400, {"error": "invalid JSON"})
+            return
+        try:
+            response = self.server.answer(self.path, request)
+        except KeyError, e:
+            self.send_json(400, {"error": "missing " + str(e)})
+            return
+        except ValueError, e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception, e:
+            self.send_json(500, {"error": str(e)})
+            return
+        if response is None:
+            self.send_json(404, {"error": "not found"})
+        else:
+            self.server.served += 1
+            self.send_json(200, response)
+
+    def send_json(self, code, response):
+        body = json.dumps(response, indent=1)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if VERBOSE:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Run the conversion service on address ([host:]port, localhost by default) until
+# Ctrl-C or SIGTERM. The token the requests must carry is new for every run and
+# written to SERVICE_TOKEN_FILE, only readable by the user running the service.
+def serve(address, jobs):
+    signal.signal(signal.SIGTERM, interrupt)
+
+    host, port = address.rsplit(":", 1) if ":" in address else ("127.0.0.1", address)
+    token = binascii.hexlify(os.urandom(16))
+    if not os.path.isdir(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+    token_file = os.path.join(CACHE_DIR, SERVICE_TOKEN_FILE)
+    if os.path.exists(token_file):
+        os.remove(token_file)
+    with os.fdopen(os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), "w") as fh:
+        fh.write(token)
+    server = ConversionService((host, int(port)), jobs, token)
+    try:
+        server.refresh()
+        print colorama.Style.BRIGHT + "Serving on http://%s:%d/, press Ctrl-C to stop..." % server.server_address
+        print colorama.Style.RESET_ALL + "The requests must carry the header 'Authorization: Bearer TOKEN', TOKEN being in " + token_file
+        print ""
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print colorama.Style.RESET_ALL + "Stopped serving."
+    finally:
+        server.server_close()
+        server.stop_pool()
+        os.remove(token_file)
+        shutdown()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Convert 3DS roms to CIA files.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show make_cia output and more details")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="convert N roms in parallel (0 = one per CPU)")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="save the scan results to FILE and reuse them for unchanged roms")
+    parser.add_argument("--extract-certs", metavar="CIA",
+                        help="save the certificate chain of CIA to certchain.bin, so CIAs can be built without make_cia")
+    parser.add_argument("--import-xorpads", nargs="*", metavar="PATH",
+                        help="import the xorpads of the loose files and zips in PATH (default: the xorpads directory) into xorpads/%s "
+                             "and exit, only keeping what the conversions need" % XORPAD_PACK)
+    parser.add_argument("--remove-imported", action="store_true",
+                        help="with --import-xorpads, remove the xorpad files and zips once imported")
+    parser.add_argument("--list", nargs="?", const="", metavar="TEXT",
+                        help="list the roms seen so far (optionally only the ones matching TEXT) and exit")
+    parser.add_argument("--ncchinfo", metavar="FILE",
+                        help="where to write the ncchinfo entries of the roms missing their xorpads (default: ncchinfo.bin)")
+    parser.add_argument("--ncchinfo-sections", default="exheader", metavar="SECTIONS",
+                        help="comma separated sections to generate xorpads for, among exheader, exefs and romfs (default: exheader, all conversions need)")
+    parser.add_argument("--ncchinfo-max-entries", type=int, metavar="N",
+                        help="split the ncchinfo entries in several files of at most N entries")
+    parser.add_argument("--ncchinfo-max-mb", type=int, metavar="MB",
+                        help="split the ncchinfo entries in several files generating at most MB megabytes of xorpads each")
+    parser.add_argument("--verify", nargs="?", const="", metavar="FILE",
+                        help="check the CIAs in the cia directory against their TMD and exit, writing the results as JSON to FILE ('-' for stdout) when given")
+    parser.add_argument("--resume", action="store_true",
+                        help="go on with the conversions of an interrupted run where they stopped instead of starting them over")
+    parser.add_argument("--scratch", metavar="DIR",
+                        help="where the roms are extracted for make_cia, in DIR/%s (default: the work directory), "
+                             "best on the filesystem of the cia directory" % SCRATCH_SUBDIR)
+    parser.add_argument("--ram-scratch", type=int, default=RAM_SCRATCH_MAX / (1024 * 1024), metavar="MB",
+                        help="extract the roms needing at most MB megabytes of scratch space to RAM (/dev/shm) when there is room "
+                             "(default: %d, 0 to never use RAM)" % (RAM_SCRATCH_MAX / (1024 * 1024)))
+    parser.add_argument("--force", action="store_true",
+                        help="convert every rom, even the ones whose CIA was already built from the same rom and xorpad")
+    parser.add_argument("--watch", action="store_true",
+                        help="run without prompts, watching the roms and xorpads directories and converting the roms as they become ready")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="run the conversion service on PORT (of localhost unless HOST is given) instead of converting the roms directory")
+    parser.add_argument("--output", metavar="TARGET",
+                        help="where to write the CIAs instead of the cia directory: another directory, a .zip, .tar, .tar.gz or .tar.bz2 archive, "
+                             "or a single CIA to a named pipe or stdout ('-')")
+    parser.add_argument("--block-size", type=int, default=CHUNK_SIZE / 1024, metavar="KB",
+                        help="size of the blocks read and written (default: %d)" % (CHUNK_SIZE / 1024))
+    parser.add_argument("--queue-depth", type=int, default=PIPELINE_DEPTH, metavar="N",
+                        help="blocks queued between the reading, hashing and writing threads (default: %d)" % PIPELINE_DEPTH)
+    parser.add_argument("--report", metavar="FILE",
+                        help="write the time and throughput of every stage, per rom and in total, to FILE (CSV if it ends with .csv, JSON otherwise)")
+    parser.add_argument("--profile", metavar="FILE", help="profile the run with cProfile and save the stats to FILE")
+    args = parser.parse_args()
+    if args.extract_certs:
+        args.extract_certs = os.path.abspath(args.extract_certs)
+    if args.import_xorpads:
+        args.import_xorpads = [os.path.abspath(path) for path in args.import_xorpads]
+    VERBOSE = args.verbose
+    PROFILE = args.profile is not None
+    FORCE = args.force
+    if args.block_size <= 0 or args.queue_depth <= 0:
+        parser.error("the block size and queue depth must be positive")
+    CHUNK_SIZE = args.block_size * 1024
+    PIPELINE_DEPTH = args.queue_depth
+    # the default ncchinfo.bin is next to 3ds-to-cia, like the other directories
+    NCCHINFO_OPTIONS = {"output": os.path.abspath(args.ncchinfo) if args.ncchinfo else "ncchinfo.bin", "sections": args.ncchinfo_sections.split(","),
+                        "max_entries": args.ncchinfo_max_entries, "max_mb": args.ncchinfo_max_mb}
+    for section in NCCHINFO_OPTIONS["sections"]:
+        if section not in ("exheader", "exefs", "romfs"):
+            parser.error("unknown ncchinfo section " + section)
+    if args.verify and args.verify != "-":
+        args.verify = os.path.abspath(args.verify)
+    if args.report:
+        args.report = os.path.abspath(args.report)
+    if args.profile:
+        args.profile = os.path.abspath(args.profile)
+    if args.output and (args.watch or args.serve or args.verify is not None):
+        parser.error("--output cannot be used with --watch, --serve or --verify")
+    if args.output and args.output != "-":
+        args.output = os.path.abspath(args.output)
+    if args.jobs <= 0:
+        args.jobs = multiprocessing.cpu_count()
+    if args.scratch:
+        # the directory given is left alone, only what is in its own subdirectory is removed
+        WORK_DIR = os.path.join(os.path.abspath(args.scratch), SCRATCH_SUBDIR)
+    if args.ram_scratch < 0:
+        parser.error("the RAM scratch size cannot be negative")
+    RAM_SCRATCH_MAX = args.ram_scratch * 1024 * 1024
+
     os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
 
     colorama.init()
 
+    if args.list is not None:
+        list_catalog(args.list)
+        sys.exit(0)
+
+    if args.extract_certs:
+        extract_certchain(args.extract_certs)
+        print "Certificate chain saved to " + CERTCHAIN_FILE
+        sys.exit(0)
+
+    if args.import_xorpads is not None:
+        stats = import_xorpads(args.import_xorpads or [XORPAD_DIR], args.remove_imported)
+        close_archives()
+        print "%d xorpads imported from %d files (%d MB): %d stored, %d already in the pack, %d skipped." % (
+            stats["xorpads"], stats["sources"], stats["source_bytes"] / (1024 * 1024), stats["stored"],
+            stats["deduplicated"], stats["skipped"])
+        print "%s is %d KB." % (os.path.join(XORPAD_DIR, XORPAD_PACK), stats["pack_bytes"] / 1024)
+        if args.remove_imported:
+            print "%d files removed." % stats["removed"]
+        sys.exit(0)
+
+    if args.verify is not None:
+        if os.path.isdir("xorpads"):
+            load_xorpad_index()
+        else:
+            xorpad_index = {}
+        cias = sorted(glob.glob(os.path.join("cia", "*.[cC][iI][aA]")))
+        certchain = make_cia = tmpdir = None
+        # the JSON goes alone to stdout
+        stdout = sys.stdout
+        if args.verify == "-":
+            sys.stdout = sys.stderr
+        start = time.time()
+        try:
+            results = verify_cias(cias, args.jobs)
+        finally:
+            sys.stdout = stdout
+        report = {"seconds": round(time.time() - start, 6), "jobs": args.jobs, "cias": results}
+        if args.verify == "-":
+            json.dump(report, sys.stdout, indent=1)
+            print ""
+        elif args.verify:
+            with open(args.verify, "w") as fh:
+                json.dump(report, fh, indent=1)
+        invalid = len([result for result in results if result["status"] != "ok"])
+        print >> (sys.stderr if args.verify == "-" else sys.stdout), "%d CIAs checked, %d invalid." % (len(results), invalid)
+        sys.exit(1 if invalid else 0)
+
+    certchain = load_certchain()
     make_cia = which("make_cia")
 
-    if make_cia is None:
+    if make_cia is None and certchain is None:
         print colorama.Fore.RED + "make_cia not found."
-        print colorama.Style.RESET_ALL
+        print colorama.Style.RESET_ALL + "Put make_cia in your PATH, or a %s extracted with --extract-certs next to 3ds-to-cia." % CERTCHAIN_FILE
         sys.exit(1)
 
-    if not os.path.isdir("cia"):
-        os.mkdir("cia")
+    if args.output:
+        output_sink = open_sink(args.output)
+        if output_sink is None:
+            CIA_DIR = args.output
+        elif args.output == "-":
+            # the CIA goes alone to stdout
+            sys.stdout = sys.stderr
+    if not os.path.isdir(CIA_DIR):
+        os.makedirs(CIA_DIR)
+
+    if args.serve:
+        setup(verbose=VERBOSE)
+        serve(args.serve, args.jobs)
+        sys.exit(0)
 
     if BITS == "32":
         print colorama.Fore.YELLOW + "You are using a 32-bit OS."
         print "You won't be able to convert some big roms (2GB+)."
         print colorama.Style.RESET_ALL
 
-    roms = glob.glob(os.path.join("roms", "*.[3zZ][dDiI][sSpP]"))
+    if args.watch:
+        for directory in ["roms", "xorpads"]:
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+
+    # the progress of the conversions is recorded, so that they can be resumed if interrupted
+    JOURNAL = True
+    RESUME = args.resume
+
+    roms = glob.glob(os.path.join("roms", ROM_PATTERN))
     tmpdir = tempfile.mkdtemp()
+    start = time.time()
+    stage_stats = collections.OrderedDict()
+    results = []
+    profiler = None
+    if PROFILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        if roms == []:
+        if roms == [] and not args.watch:
             print "No valid files in rom directory found."
             sys.exit(1)
 
         print colorama.Fore.GREEN + "Work in progress... Please wait..."
         print colorama.Style.RESET_ALL
 
-        check = True
-        while True:
-            missing_xorpads = []
-            if check:
-                print colorama.Style.BRIGHT + "Checking for xorpads..."
+        print colorama.Style.BRIGHT + "Checking for xorpads..."
+        print colorama.Style.RESET_ALL
+        with timed("scan"):
+            load_xorpad_index()
+            manifest = scan_roms(roms, load_manifest(args.manifest))
+            save_manifest(args.manifest, manifest)
+            update_catalog(manifest, roms)
+
+        if args.watch:
+            watch_roms(manifest, results, args.jobs, args.manifest)
+            sys.exit(0)
+
+        while any(row["xorpad"] == "missing" for row in manifest):
+            with timed("ncchinfo"):
+                outputs = generate_ncchinfo(manifest)
+            print ""
+
+            if len(outputs) > 1:
+                print "Copy each of %s in turn to your 3DS as ncchinfo.bin and make it generates the required xorpads" % ", ".join(outputs)
             else:
-                print colorama.Style.BRIGHT + "Creating CIA..."
-            print colorama.Style.RESET_ALL
-            for rom in roms:
-                if zipfile.is_zipfile(rom):
-                    print rom
-                    with zipfile.ZipFile(rom, "r") as e:
-                        for entry in e.infolist():
-                            basename = os.path.basename(entry.filename)
-                            if not basename or not basename.lower().endswith(".3ds"):
-                                continue
-                            if check or VERBOSE == False:
-                                sys.stdout.write("\t-> " + entry.filename + " ")
-                                sys.stdout.flush()
-                            else:
-                                print "\t-> " + entry.filename
-                                print ""
-                            crc32 = entry.CRC & 0xFFFFFFFF
-                            filename = os.path.join(tmpdir, basename)
-                            source = e.open(entry, "r")
-                            if check:
-                                with open(filename, "wb") as target:
-                                    target.write(e.open(entry, 'r').read(0x10000))
-                                main_check(filename, True)
-                            else:
-                                target = file(filename, "wb")
-                                with source, target:
-                                    shutil.copyfileobj(source, target)
-                                convert_to_cia(filename, crc32)
-                                os.remove(filename)
-
-                            sys.stdout.write(colorama.Style.RESET_ALL)
-                            sys.stdout.flush()
-                else:
-                    if check or VERBOSE == False:
-                        sys.stdout.write(rom + " ")
-                        sys.stdout.flush()
-                    else:
-                        print rom
-                        print ""
-                    crc32 = 0
-                    with open(rom, "rb") as fh:
-                        while True:
-                            buf = fh.read(0x10000)
-                            if not buf: break
-                            crc32 = binascii.crc32(buf, crc32)
-                        crc32 = crc32 & 0xFFFFFFFF
-                    if check:
-                        main_check(rom, False)
-                    else:
-                        convert_to_cia(rom, crc32)
-                    sys.stdout.write(colorama.Style.RESET_ALL)
-                    sys.stdout.flush()
-
-                print ""
-
-            if check == False:
-                break
+                print "Copy %s to your 3DS and make it generates the required xorpads" % outputs[0]
+            print "Then copy the generated xorpads in the 'xorpads' directory"
+            print ""
+            with timed("wait"):
+                raw_input("Press Enter to continue...")
 
-            if missing_xorpads != []:
-                ncchinfo_gen(missing_xorpads)
+            print colorama.Style.BRIGHT + "Checking for xorpads..."
+            print colorama.Style.RESET_ALL
+            with timed("scan"):
+                load_xorpad_index()
+                recheck_manifest(manifest)
+                save_manifest(args.manifest, manifest)
 
-                print "Copy ncchinfo.bin to your 3DS and make it generates the required xorpads"
-                print "Then copy the generated xorpads in the 'xorpads' directory"
-                print ""
-                raw_input("Press Enter to continue...")
-            else:
-                check = False
+        if isinstance(output_sink, StreamSink) and len(manifest) > 1:
+            print colorama.Fore.RED + "Only one CIA can be written to %s, %d roms were found." % (output_sink.target, len(manifest))
+            print colorama.Style.RESET_ALL
+            sys.exit(1)
+        convert_rows(manifest, results, args.jobs)
 
     finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, args.profile, results)
+        if args.report:
+            write_report(args.report, stage_stats, results, time.time() - start, args.jobs)
+        close_archives()
+        if output_sink is not None:
+            output_sink.close()
         shutil.rmtree(tmpdir)
-        raw_input("Press Enter to continue...")
+        for directory in (WORK_DIR, RAM_WORK_DIR):
+            if directory is not None and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+        if not args.watch:
+            raw_input("Press Enter to continue...")
@@ -0,0 +1,329 @@
+#!/usr/bin/env python2
+
+# Benchmarks for the hot paths of 3ds-to-cia, run on synthetic roms
+#
+# usage: ./benchmark.py [--size MB] [--layout MB,MB,...] [--variants ...] [--json FILE]
+
+import os
+import sys
+import imp
+import time
+import json
+import struct
+import hashlib
+import binascii
+import zipfile
+import tempfile
+import shutil
+import argparse
+import contextlib
+import platform
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+converter = imp.load_source("converter", os.path.join(os.path.dirname(os.path.abspath(__file__)), "3ds-to-cia.py"))
+
+# zipped roms are deflated, stored ones are in a zip without compression
+VARIANTS = ["plain-encrypted", "plain-nocrypto", "zipped-encrypted", "zipped-nocrypto", "stored-encrypted", "stored-nocrypto"]
+
+TITLEID = 0x0004000000123400
+
+# Stands in for make_cia: reads every content and writes them to the output file
+MAKE_CIA_STUB = """
+import sys
+output = None
+contents = []
+args = sys.argv[1:]
+for i in range(len(args)):
+    if args[i] == "-o":
+        output = args[i + 1]
+    elif args[i].startswith("--content"):
+        contents.append(args[i].split("=", 1)[1])
+with open(output, "wb") as out:
+    for content in contents:
+        with open(content, "rb") as fh:
+            while True:
+                buf = fh.read(0x100000)
+                if not buf: break
+                out.write(buf)
+"""
+
+# The original byte-by-byte implementation of xor(), kept for comparison
+def legacy_xor(bytes, xorpad):
+    if len(bytes) > len(xorpad):
+        raise Exception("xorpad is too small")
+
+    result = b""
+    for x in range(len(bytes)):
+        result += struct.pack("B", bytes[x] ^ xorpad[x])
+    return bytearray(result)
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+results = []
+
+def measure(variant, stage, size, func, *args):
+    start = time.time()
+    ret = func(*args)
+    elapsed = max(time.time() - start, 1e-9)
+    results.append({
+        "variant": variant,
+        "stage": stage,
+        "bytes": size,
+        "seconds": round(elapsed, 6),
+        "mb_per_s": round(size / elapsed / (1024 * 1024), 2),
+        "peak_rss_kb": peak_rss(),
+    })
+    print >> sys.stderr, "%-18s %-12s %12d bytes %10.3f s %10.2f MB/s" % (variant, stage, size, elapsed, size / elapsed / (1024 * 1024))
+    return ret
+
+def bench_xor(size):
+    small = bytearray(os.urandom(0x400))
+    medium = bytearray(os.urandom(0x10000))
+    big = bytearray(os.urandom(size))
+
+    measure("xor", "legacy x100", len(small) * 100, lambda: [legacy_xor(small, small) for i in xrange(100)])
+    measure("xor", "legacy", len(medium), legacy_xor, medium, medium)
+    measure("xor", "bulk x100", len(small) * 100, lambda: [converter.xor(small, small) for i in xrange(100)])
+    measure("xor", "bulk", len(big), converter.xor, big, big)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = os.path.join(tmpdir, "data.bin")
+        xorpad = os.path.join(tmpdir, "data.xorpad")
+        with open(data, "wb") as fh:
+            fh.write(big)
+        with open(xorpad, "wb") as fh:
+            fh.write(big)
+        with open(data, "r+b") as fh, open(xorpad, "rb") as xorpad_fh:
+            measure("xor", "file", len(big), converter.xor_file, fh, 0, len(big), xorpad_fh)
+    finally:
+        shutil.rmtree(tmpdir)
+
+# NCCH header and exheader of a synthetic partition, returns (header + exheader, exheader xorpad or None)
+def make_ncch(titleid, size, encrypted):
+    header = converter.ncchHdr()
+    header.magic = b"NCCH"
+    header.ncchSize = size / converter.mediaUnitSize
+    for i, c in enumerate(bytearray(struct.pack("<Q", titleid))):
+        header.titleId[i] = c
+        header.programId[i] = c
+    for i, c in enumerate(bytearray(b"CTR-P-BNCH".ljust(0x10, b"\x00"))):
+        header.productCode[i] = c
+    header.exhdrSize = 0x400
+    header.exefsOffset = 0x6
+    header.exefsSize = 0x1
+    header.flags[7] = 0 if encrypted else 0x4
+
+    exheader = bytearray(os.urandom(0x400))
+    exheader[0xD] = 0
+    exheader[0xE:0x10] = struct.pack("<H", 0)
+    exheader[0x1C0:0x1C8] = struct.pack("<Q", 512 * 1024)
+    for i, c in enumerate(bytearray(converter.sha256(exheader))):
+        header.exhdrHash[i] = c
+
+    xorpad = None
+    if encrypted:
+        xorpad = bytearray(os.urandom(0x400))
+        exheader = converter.xor(exheader, xorpad)
+    return bytes(bytearray(header)) + bytes(exheader), xorpad
+
+# Write a synthetic .3ds whose partitions have the given sizes (bytes, 0 for
+# no partition) and return (crc32, exheader xorpad or None)
+def make_rom(filename, layout, encrypted):
+    ncsd = converter.ncsdHdr()
+    ncsd.magic = b"NCSD"
+    for i, c in enumerate(bytearray(struct.pack("<Q", TITLEID))):
+        ncsd.titleId[i] = c
+
+    offset = 0x4000
+    for i, size in enumerate(layout):
+        if size:
+            ncsd.offset_sizeTable[i].offset = offset / converter.mediaUnitSize
+            ncsd.offset_sizeTable[i].size = size / converter.mediaUnitSize
+            offset += size
+    ncsd.mediaSize = offset / converter.mediaUnitSize
+
+    crc32 = 0
+    xorpad = None
+    with open(filename, "wb") as fh:
+        def write(buf):
+            fh.write(buf)
+            return binascii.crc32(buf, crc32)
+
+        crc32 = write(bytes(bytearray(ncsd)).ljust(0x4000, b"\x00"))
+        for i, size in enumerate(layout):
+            if not size:
+                continue
+            headers, pad = make_ncch(TITLEID + i, size, encrypted and i == 0)
+            if i == 0:
+                xorpad = pad
+            crc32 = write(headers)
+            left = size - len(headers)
+            while left > 0:
+                crc32 = write(os.urandom(min(left, 0x100000)))
+                left -= min(left, 0x100000)
+
+    return crc32 & 0xFFFFFFFF, xorpad
+
+def bench_variant(variant, layout, workroot):
+    container, crypto = variant.split("-")
+    encrypted = crypto == "encrypted"
+    size = sum(layout) + 0x4000
+
+    root = os.path.join(workroot, variant)
+    for name in ["roms", "xorpads", "work", "cia", "cache"]:
+        os.makedirs(os.path.join(root, name))
+    converter.CACHE_DIR = os.path.join(root, "cache")
+    converter.xorpad_index = None
+    work = os.path.join(root, "work")
+
+    rom = os.path.join(root, "roms", "bench.3ds")
+    crc32, pad = make_rom(rom, layout, encrypted)
+    xorpad_dir = os.path.join(root, "xorpads")
+    if pad is not None:
+        with open(os.path.join(xorpad_dir, "%016X.%08x.Main.exheader.xorpad" % (TITLEID, crc32)), "wb") as fh:
+            fh.write(pad)
+            fh.write(os.urandom(0x100000))
+
+    # zipped roms are read straight from the archive, like the converter does
+    open_rom = lambda: open(rom, "rb")
+    if container != "plain":
+        archive = os.path.join(root, "roms", "bench.zip")
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED if container == "zipped" else zipfile.ZIP_STORED, True) as e:
+            e.write(rom, "bench.3ds")
+        os.remove(rom)
+        open_rom = lambda: converter.ZipRomReader(archive, "bench.3ds")
+    with contextlib.closing(open_rom()) as fh:
+        measure(variant, "crc", size, converter.file_crc32, fh)
+        # the single pass against the chunked crc32 on every CPU, whatever crc32_plan() picks for this rom
+        raw = converter.rom_file_range(fh)
+        if raw is not None:
+            processes = max(multiprocessing.cpu_count(), 2)
+            chunk_size = -(-size / (processes * 4))
+            measure(variant, "crc serial", size, converter.crc32_range, (raw[0].name, raw[1], size))
+            measure(variant, "crc chunked", size, converter.parallel_crc32, raw[0].name, raw[1], size, chunk_size, processes)
+
+    xorpad = None
+    if encrypted:
+        converter.load_xorpad_index(xorpad_dir)
+        xorpad = measure(variant, "lookup", 0, converter.lookup_xorpad, "%016X" % TITLEID, crc32)
+        measure(variant, "read xorpad", 0x400, converter.read_xorpad, xorpad, 0x400)
+        # the same xorpad imported into the pack, the loose one is still used below
+        converter.XORPAD_DIR = xorpad_dir
+        measure(variant, "import", os.path.getsize(xorpad[0]), converter.import_xorpads, [xorpad[0]])
+        packed = converter.load_xorpad_index(xorpad_dir)[("%016X" % TITLEID, crc32, "main", "exheader")]
+        measure(variant, "read packed", 0x400, converter.read_xorpad, packed, 0x400)
+
+    with contextlib.closing(open_rom()) as fh:
+        measure(variant, "verify", 0x400, converter.verify_xorpad, fh, xorpad)
+        measure(variant, "split", size, converter.extract_rom, fh, work)
+        measure(variant, "extract", sum(layout), converter.extract_rom, fh, work, crc32)
+
+    cxi = os.path.join(work, "0.cxi")
+    measure(variant, "fix", 0x400, converter.fix_cxi, cxi, xorpad)
+
+    stub = os.path.join(root, "make_cia_stub.py")
+    with open(stub, "w") as fh:
+        fh.write(MAKE_CIA_STUB)
+    cmdline = [sys.executable, stub, "-o", os.path.join(root, "cia", "make_cia.cia")]
+    for i, partition_size in enumerate(layout[:6]):
+        if partition_size:
+            cmdline.append("--content%d=%s" % (i, os.path.join(work, "%d.%s" % (i, "cxi" if i == 0 else "cfa"))))
+    measure(variant, "make_cia", sum(layout[:6]), subprocess.call, cmdline)
+
+    # read ahead and write behind like the converter
+    def build(fh, out):
+        source = converter.ReadAhead(fh, size, "build")
+        sink = converter.WriteBehind(out, "build")
+        try:
+            # a dummy certificate chain, only its size matters here
+            return converter.build_cia(source, sink, xorpad, b"\x00" * 0xA00)
+        finally:
+            source.close()
+            sink.close()
+
+    with contextlib.closing(open_rom()) as fh, open(os.path.join(root, "cia", "native.cia"), "wb") as out:
+        measure(variant, "build", size, build, fh, out)
+    measure(variant, "verify cia", size, converter.verify_cia, os.path.join(root, "cia", "native.cia"))
+
+    # the same CIA deflated into a zip archive, reading the rom twice like for any output sink
+    def stream(archive):
+        sink = converter.ZipSink(archive)
+        roms = []
+        def read_rom():
+            roms.append(open_rom())
+            return converter.ReadAhead(roms[-1], size, "build")
+        try:
+            return converter.stream_cia(read_rom, lambda cia_size: sink.open("native.cia", cia_size), xorpad, b"\x00" * 0xA00)
+        finally:
+            for fh in roms:
+                fh.close()
+            sink.close()
+
+    measure(variant, "stream zip", size * 2, stream, os.path.join(root, "cia", "native.zip"))
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "wb")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark 3ds-to-cia on synthetic roms.")
+    parser.add_argument("--size", type=int, default=64, metavar="MB", help="size of the main partition (default: 64)")
+    parser.add_argument("--layout", metavar="MB,MB,...",
+                        help="size of each NCSD partition, 0 for none (default: main partition, 1/16 manual, 1/32 download play)")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="comma separated list among " + ", ".join(VARIANTS))
+    parser.add_argument("--no-xor", action="store_true", help="skip the xor benchmark")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args()
+
+    if args.layout:
+        layout = [int(float(size) * 1024 * 1024) for size in args.layout.split(",")]
+    else:
+        layout = [args.size * 1024 * 1024, args.size * 1024 * 1024 / 16, args.size * 1024 * 1024 / 32]
+    # partitions are made of whole media units
+    layout = [size - size % converter.mediaUnitSize for size in layout]
+    if not layout or layout[0] < 0x1000:
+        parser.error("the main partition must be at least 4 KB")
+
+    print >> sys.stderr, "numpy: %s" % ("yes" if converter.numpy is not None else "no")
+    if not args.no_xor:
+        bench_xor(layout[0])
+
+    workroot = tempfile.mkdtemp()
+    try:
+        for variant in args.variants.split(","):
+            if variant not in VARIANTS:
+                parser.error("unknown variant " + variant)
+            bench_variant(variant, layout, workroot)
+    finally:
+        converter.close_archives()
+        shutil.rmtree(workroot)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": converter.numpy is not None,
+        "layout": layout,
+        "results": results,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=1)
+        print ""
+    elif args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=1)